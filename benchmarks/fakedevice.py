@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Fake android devices for benchmarks without a phone: a stub of the uiautomator
+json-rpc server on each device, and an adb server speaking the host protocol.
+Together with the fake adb executable in platform-tools, uiautomator starts,
+calls and stops the rpc server of fake devices the same way as real ones.
+'''
+
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import socket
+import threading
+import collections
+import BaseHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uiautomator
+
+ANDROID_HOME = os.path.dirname(os.path.abspath(__file__))  # platform-tools/adb is the fake adb executable.
+
+
+def _node(attrs, children=""):
+    a = dict(index=0, text="", rid="", cls="android.widget.TextView", pkg="com.android.settings", desc="",
+             checkable="false", checked="false", clickable="false", scrollable="false", bounds="[0,0][720,100]")
+    a.update(attrs)
+    return ('<node index="%(index)d" text="%(text)s" resource-id="%(rid)s" class="%(cls)s" package="%(pkg)s" '
+            'content-desc="%(desc)s" checkable="%(checkable)s" checked="%(checked)s" clickable="%(clickable)s" '
+            'enabled="true" focusable="false" focused="false" scrollable="%(scrollable)s" long-clickable="false" '
+            'password="false" selected="false" bounds="%(bounds)s">' % a) + children + "</node>"
+
+
+def hierarchy(rows=50, first=0, repeated=False):
+    '''
+    window hierarchy of a settings like list, with 3 nodes per row, starting
+    from row first. Titles of rows are all the same if repeated.
+    '''
+    items = "".join(_node(dict(index=i - first, cls="android.widget.LinearLayout", clickable="true",
+                               bounds="[0,%d][720,%d]" % ((i - first) * 100, (i - first) * 100 + 100)),
+                          _node(dict(index=0, text="Item" if repeated else "Item %d" % i, rid="android:id/title")) +
+                          _node(dict(index=1, cls="android.widget.CheckBox", checkable="true",
+                                     checked="true" if i % 2 else "false", rid="android:id/checkbox")))
+                    for i in range(first, first + rows))
+    frame = _node(dict(cls="android.widget.FrameLayout"),
+                  _node(dict(cls="android.widget.ListView", scrollable="true", rid="android:id/list"), items))
+    return '<?xml version=\'1.0\' encoding=\'UTF-8\' standalone=\'yes\' ?><hierarchy rotation="0">%s</hierarchy>' % frame
+
+
+def screenshot(size=256 * 1024):
+    '''png-like data of the given size.'''
+    return "\x89PNG\r\n\x1a\n" + os.urandom(max(size - 8, 0))
+
+
+class FakeDevice(object):
+
+    '''
+    device running the stub of uiautomator rpc server. Every rpc call sleeps
+    latency seconds, and the server is ready launch_latency seconds after
+    `uiautomator runtest`. Selectors are evaluated on the window hierarchy.
+    '''
+
+    def __init__(self, serial, latency=0.0, launch_latency=0.0, rows=50, png_size=256 * 1024):
+        self.serial = serial
+        self.latency = latency
+        self.launch_latency = launch_latency
+        self.fs = {}  # device path: (data, mtime)
+        self.running = False
+        self.calls = collections.Counter()
+        self.requests = 0
+        self.connections = 0  # tcp connections accepted by the rpc server
+        self.history = None  # list of (method, params) of rpc calls once set to a list
+        self.inline_dump = True  # return the xml instead of writing dump file if no filename is given.
+        self.gzip = True  # gzip encoding of responses larger than 1KB, if accepted.
+        self.stalls = {}  # method: (every, seconds), every nth call of the method sleeps seconds more
+        self.drops = collections.Counter()  # method: times the connection is closed after the call, without response
+        self.png = screenshot(png_size)
+        self.set_hierarchy(hierarchy(rows))
+        self.__rpc_servers = {}
+        self.__lock = threading.Lock()
+
+    def set_hierarchy(self, xml):
+        self.xml = xml
+        self.snapshot = uiautomator._Snapshot(xml)
+        self.__list = None
+
+    def set_list(self, rows, visible, repeated=False):
+        '''show visible rows of a list of rows, which scrolls by half of visible rows.'''
+        self.set_hierarchy(hierarchy(min(visible, rows), repeated=repeated))
+        self.__list = [rows, min(visible, rows), 0, repeated]  # rows, visible rows, the first visible row, repeated
+
+    def __scroll(self, forward):
+        if self.__list is None:
+            return False
+        rows, visible, first, repeated = self.__list
+        step = max(visible / 2, 1)
+        first = min(first + step, rows - visible) if forward else max(first - step, 0)
+        if first == self.__list[2]:
+            return False
+        xml = hierarchy(visible, first, repeated)
+        self.xml, self.snapshot = xml, uiautomator._Snapshot(xml)
+        self.__list[2] = first
+        return True
+
+    def __find(self, selector):
+        return self.snapshot.find_all(selector)
+
+    def __info(self, selector):
+        nodes = self.__find(selector)
+        if not nodes:
+            raise LookupError("UiObjectNotFoundException")
+        return nodes[0].info
+
+    def __exist(self, selector, *args):
+        return len(self.__find(selector)) > 0
+
+    def __dump(self, compressed, filename):
+        if filename is None and self.inline_dump:
+            return self.xml
+        path = "/data/local/tmp/" + (filename or "null")
+        self.fs[path] = (self.xml, int(time.time()))
+        return path
+
+    def __screenshot(self, filename, scale, quality):
+        path = "/data/local/tmp/" + filename
+        self.fs[path] = (self.png, int(time.time()))
+        return path
+
+    def rpc(self, method, params):
+        '''invoke the rpc method, raise KeyError if not found.'''
+        handlers = {
+            "ping": lambda: "pong",
+            "deviceInfo": lambda: {"displayRotation": 0, "displayWidth": 720, "displayHeight": 1280,
+                                   "sdkInt": 18, "currentPackageName": "com.android.settings",
+                                   "productName": self.serial, "naturalOrientation": True},
+            "objInfo": self.__info,
+            "exist": self.__exist,
+            "waitForExists": self.__exist,
+            "waitUntilGone": lambda selector, *args: not self.__exist(selector),
+            "dumpWindowHierarchy": self.__dump,
+            "takeScreenshot": self.__screenshot,
+            "getLastTraversedText": lambda: None,
+            "hasWatcherTriggered": lambda name: False,
+            "scrollForward": lambda selector, vertical, steps: self.__scroll(True),
+            "scrollBackward": lambda selector, vertical, steps: self.__scroll(False),
+        }
+        with self.__lock:
+            self.calls[method] += 1
+            if self.history is not None:
+                self.history.append((method, params))
+            every, stall = self.stalls.get(method, (0, 0))
+            stalled = every and self.calls[method] % every == 0
+        if self.latency:
+            time.sleep(self.latency)
+        if stalled:
+            time.sleep(stall)
+        if method in handlers:
+            return handlers[method](*params)
+        elif method in _actions:
+            return True
+        raise KeyError(method)
+
+    def dropped(self, method):
+        '''whether to close the connection after the call of method, consuming one of its drops.'''
+        with self.__lock:
+            if self.drops[method] <= 0:
+                return False
+            self.drops[method] -= 1
+            return True
+
+    def listen(self, port):
+        '''serve rpc on the local port forwarded to the device.'''
+        if port not in self.__rpc_servers:
+            server = _RpcServer(("127.0.0.1", port), _RpcHandler)
+            server.device = self
+            self.__rpc_servers[port] = server
+            _serve_in_thread(server)
+
+    def close(self):
+        for server in self.__rpc_servers.values():
+            server.shutdown()
+            server.server_close()
+        self.__rpc_servers.clear()
+
+
+_actions = set([
+    "click", "clickAndWaitForNewWindow", "longClick", "swipe", "drag", "dragTo", "pressKey", "pressKeyCode",
+    "wakeUp", "sleep", "freezeRotation", "setOrientation", "openNotification", "openQuickSettings",
+    "waitForIdle", "waitForWindowUpdate", "setText", "clearTextField", "clearLastTraversedText",
+    "gesture", "pinchIn", "pinchOut", "fling", "flingForward", "flingBackward", "flingToBeginning",
+    "flingToEnd", "scroll", "scrollForward", "scrollBackward", "scrollToBeginning", "scrollToEnd", "scrollTo",
+    "registerClickUiObjectWatcher", "registerPressKeyskWatcher", "removeWatcher", "resetWatcherTriggers",
+    "runWatchers", "getWatchers", "stop"
+])
+
+
+class _RpcHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # large responses are not delayed by the ack of the previous segment
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.device.connections += 1
+
+    def __call(self, request):
+        response = {"jsonrpc": "2.0", "id": request.get("id")}
+        try:
+            response["result"] = self.server.device.rpc(request["method"], request.get("params", []))
+        except KeyError as e:
+            response["error"] = {"code": -32601, "message": "Method not found: %s" % e}
+        except Exception as e:
+            response["error"] = {"code": -32001, "message": "%s: %s" % (type(e).__name__, e)}
+        return response
+
+    def do_POST(self):
+        device = self.server.device
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if not device.running:  # server is not launched on device, connection is reset.
+            self.close_connection = 1
+            return
+        device.requests += 1
+        request = json.loads(body)
+        if isinstance(request, list):
+            response = [self.__call(r) for r in request]
+        else:
+            response = self.__call(request)
+            if device.dropped(request["method"]):  # done, but the response is lost.
+                self.close_connection = 1
+                return
+        data, encoding = json.dumps(response), ""
+        if device.gzip and len(data) > 1024 and "gzip" in self.headers.get("Accept-Encoding", ""):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data, encoding = compressor.compress(data) + compressor.flush(), "Content-Encoding: gzip\r\n"
+        self.wfile.write("HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n%sContent-Length: %d\r\n\r\n%s" %
+                         (encoding, len(data), data))
+
+    def do_GET(self):
+        if self.path == "/stop":
+            self.server.device.running = False
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class _RpcServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 64  # concurrent connections of coroutines are not refused and retried later.
+
+
+def _serve_in_thread(server):
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+
+
+class _AdbHandler(SocketServer.BaseRequestHandler):
+
+    def recv(self, size):
+        data = []
+        while size:
+            chunk = self.request.recv(size)
+            if not chunk:
+                raise EOFError()
+            data.append(chunk)
+            size -= len(chunk)
+        return "".join(data)
+
+    def okay(self, data=None):
+        self.request.sendall("OKAY" if data is None else "OKAY%04x%s" % (len(data), data))
+
+    def fail(self, message):
+        self.request.sendall("FAIL%04x%s" % (len(message), message))
+
+    def handle(self):
+        try:
+            self.__handle(self.recv(int(self.recv(4), 16)))
+        except (EOFError, socket.error):
+            pass
+
+    def __handle(self, request):
+        adb = self.server.adb
+        if request == "host:version":
+            return self.okay("0020")
+        elif request == "host:devices":
+            return self.okay("".join("%s\tdevice\n" % serial for serial in sorted(adb.devices)))
+        elif request == "host:list-forward":
+            return self.okay("".join("%s tcp:%d tcp:%d\n" % f for f in sorted(adb.forwards)))
+        elif ":forward:" in request:
+            prefix, spec = request.split(":forward:")
+            device = adb.device(prefix[len("host-serial:"):] if prefix.startswith("host-serial:") else None)
+            if device is None:
+                return self.fail("device not found")
+            local, remote = [int(s.split(":")[1]) for s in spec.split(";")]
+            adb.forward(device, local, remote)
+            return self.request.sendall("OKAYOKAY")
+        elif request.startswith("host:transport"):
+            device = adb.device(request[len("host:transport:"):] if request.startswith("host:transport:") else None)
+            if device is None:
+                return self.fail("device not found")
+            self.okay()
+            service = self.recv(int(self.recv(4), 16))
+            if service.startswith("shell:"):
+                self.okay()
+                self.request.sendall(self.__shell(device, service[len("shell:"):]))
+            elif service == "sync:":
+                self.okay()
+                self.__sync(device)
+            else:
+                self.fail("unknown service %s" % service)
+        else:
+            self.fail("unknown request %s" % request)
+
+    def __shell(self, device, command):
+        args = command.split()
+        if args[:2] == ["uiautomator", "runtest"]:
+            time.sleep(device.launch_latency)
+            device.running = True
+            while device.running:  # block as long as the server is running.
+                time.sleep(0.01)
+            return ""
+        elif args[:1] == ["ps"]:
+            out = "USER     PID   PPID  VSIZE  RSS   WCHAN    PC        NAME\n"
+            if device.running:
+                out += "shell     1234  1     1000   100   ffffffff 00000000 S uiautomator\n"
+            return out
+        elif args[:1] == ["kill"]:
+            device.running = False
+        elif args[:1] == ["rm"]:
+            for path in args[1:]:
+                device.fs.pop(path, None)
+        return ""
+
+    def __sync(self, device):
+        while True:
+            cmd, length = struct.unpack("<4sI", self.recv(8))
+            arg = self.recv(length)
+            if cmd == "QUIT":
+                return
+            elif cmd == "STAT":
+                data, mtime = device.fs.get(arg, (None, 0))
+                mode = 0100644 if data is not None else 0
+                self.request.sendall(struct.pack("<4sIII", "STAT", mode, len(data or ""), mtime))
+            elif cmd == "SEND":
+                path, chunks = arg.rsplit(",", 1)[0], []
+                while True:
+                    cmd, length = struct.unpack("<4sI", self.recv(8))
+                    if cmd == "DONE":
+                        break
+                    chunks.append(self.recv(length))
+                device.fs[path] = ("".join(chunks), length)
+                self.request.sendall(struct.pack("<4sI", "OKAY", 0))
+            elif cmd == "RECV":
+                data = device.fs.get(arg, (None, 0))[0]
+                if data is None:
+                    message = "No such file or directory"
+                    self.request.sendall(struct.pack("<4sI", "FAIL", len(message)) + message)
+                    continue
+                for i in range(0, len(data), 64 * 1024):
+                    chunk = data[i:i + 64 * 1024]
+                    self.request.sendall(struct.pack("<4sI", "DATA", len(chunk)) + chunk)
+                self.request.sendall(struct.pack("<4sI", "DONE", 0))
+
+
+class _AdbTcpServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeAdbServer(object):
+
+    '''
+    adb server of fake devices on a local port. Usage:
+    adb = FakeAdbServer([FakeDevice("fake-1"), FakeDevice("fake-2")])
+    adb.install()  # point uiautomator to the fake adb server and executable.
+    '''
+
+    def __init__(self, devices, port=0):
+        self.devices = dict((device.serial, device) for device in devices)
+        self.forwards = set()  # (serial, local port, device port)
+        self.__server = _AdbTcpServer(("127.0.0.1", port), _AdbHandler)
+        self.__server.adb = self
+        self.port = self.__server.server_address[1]
+        _serve_in_thread(self.__server)
+
+    def device(self, serial):
+        if serial is None:
+            return self.devices.values()[0] if len(self.devices) == 1 else None
+        return self.devices.get(serial)
+
+    def forward(self, device, local, remote):
+        self.forwards = set(f for f in self.forwards if f[1] != local)
+        self.forwards.add((device.serial, local, remote))
+        device.listen(local)
+
+    def install(self):
+        '''set environment variables, so uiautomator and adb commands talk to this server.'''
+        os.environ["ANDROID_ADB_SERVER_PORT"] = str(self.port)
+        os.environ["ANDROID_HOME"] = ANDROID_HOME
+        # the fake adb runs with "env python", make it the python running the benchmarks.
+        python_dir = os.path.dirname(sys.executable)
+        paths = os.environ.get("PATH", "").split(os.pathsep)
+        os.environ["PATH"] = os.pathsep.join([python_dir] + [p for p in paths if p != python_dir])
+        os.environ.pop("ANDROID_SERIAL", None)
+        uiautomator._adb_cmd = None
+
+    def close(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+        for device in self.devices.values():
+            device.running = False
+            device.close()
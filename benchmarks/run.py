@@ -0,0 +1,863 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks of uiautomator against fake devices, results are written as json
+for comparison across versions. Usage:
+python benchmarks/run.py --latency 0.002 --output results.json
+python benchmarks/run.py call_latency selectors
+'''
+
+import os
+import sys
+import json
+import time
+import hashlib
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import collections
+
+import jsonrpclib
+
+import fakedevice
+import uiautomator
+
+
+def summarize(samples):
+    '''statistics of samples in seconds, reported in milliseconds.'''
+    samples = sorted(samples)
+    n = len(samples)
+    if n == 0:
+        return {"n": 0}
+
+    def percentile(p):
+        return samples[min(n - 1, int(p * n))] * 1000
+
+    return {
+        "n": n,
+        "mean": sum(samples) / n * 1000,
+        "min": samples[0] * 1000,
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p99": percentile(0.99),
+        "max": samples[-1] * 1000
+    }
+
+
+def measure(func, iterations):
+    '''return elapsed seconds of each call of func.'''
+    samples = []
+    for i in range(iterations):
+        start = time.time()
+        func(i)
+        samples.append(time.time() - start)
+    return samples
+
+
+def run_threads(func, count):
+    '''run func(k) in count threads, return elapsed seconds and raise the first error.'''
+    errors = []
+
+    def run(k):
+        try:
+            func(k)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(k,)) for k in range(count)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    if errors:
+        raise errors[0]
+    return elapsed
+
+
+scenarios = collections.OrderedDict()
+
+
+def scenario(func):
+    scenarios[func.__name__] = func
+    return func
+
+
+@scenario
+def start_stop(bench):
+    '''cold start with jars pushed, warm start with jars unchanged, and stop.'''
+    result = collections.defaultdict(list)
+    serial = bench.serials[0]
+    for i in range(bench.options.starts):
+        if i == 0:
+            bench.adb.devices[serial].fs.clear()
+        d = uiautomator.Device(serial)
+        start = time.time()
+        d.server.start()
+        result["cold" if i == 0 else "warm"].append(time.time() - start)
+        for phase, elapsed in d.server.start_timing.items():
+            result["phase." + phase].append(elapsed)
+        start = time.time()
+        d.server.stop(force=True)
+        result["stop"].append(time.time() - start)
+    d = uiautomator.Device(serial)
+    start = time.time()
+    d.info
+    result["first_call"].append(time.time() - start)
+    bench.devices[serial] = d
+    result = dict((name, summarize(samples)) for name, samples in result.items())
+
+    # a download not matching its pinned sha1 is refused, and never cached.
+    pinned = dict(uiautomator._jar_digests)
+    uiautomator._jar_digests["bundle.jar"] = "0" * 40
+    try:
+        uiautomator._download_jars()
+    except EnvironmentError:
+        pass
+    else:
+        raise AssertionError("a jar not matching its pinned sha1 is used.")
+    finally:
+        uiautomator._jar_digests.update(pinned)
+    return result
+
+
+@scenario
+def call_latency(bench):
+    '''per-call latency of simple rpc calls on a running server.'''
+    d = bench.device()
+    n = bench.options.iterations
+    return {
+        "deviceInfo": summarize(measure(lambda i: d.info, n)),
+        "click": summarize(measure(lambda i: d.click(i % 720, 100), n)),
+        "press": summarize(measure(lambda i: d.press.home(), n)),
+        "exist": summarize(measure(lambda i: d(text="Item %d" % (i % bench.options.rows)).exist(), n)),
+    }
+
+
+@scenario
+def keep_alive(bench):
+    '''
+    tcp connections and rpc requests of N calls on a running server, against
+    a new jsonrpclib.Server per call after a ping, as every call did before.
+    Then N calls after the server dies, which restart it once, without pings.
+    '''
+    d = bench.device()
+    device = bench.adb.devices[d.serial]
+    n = bench.options.iterations
+
+    def legacy(i):
+        if jsonrpclib.Server(d.server.rpc_uri).ping() == "pong":
+            jsonrpclib.Server(d.server.rpc_uri).deviceInfo()
+
+    result = {"calls": n}
+    for name, func in [("legacy", legacy), ("keep_alive", lambda i: d.info)]:
+        connections, requests = device.connections, device.requests
+        result[name] = summarize(measure(func, n))
+        result[name]["connections"] = device.connections - connections
+        result[name]["requests"] = device.requests - requests
+    if result["keep_alive"]["connections"] > 1:
+        raise AssertionError("%d connections are made by %d calls." % (result["keep_alive"]["connections"], n))
+    if result["keep_alive"]["requests"] != n:
+        raise AssertionError("%d requests are made by %d calls." % (result["keep_alive"]["requests"], n))
+
+    # the server dies, the first call restarts it once and is retried.
+    device.running = False
+    pings, requests, start = device.calls["ping"], device.requests, time.time()
+    for i in range(n):
+        d.info
+    result["restart"] = {"ms": (time.time() - start) * 1000, "requests": device.requests - requests,
+                         "pings": device.calls["ping"] - pings}
+    if result["restart"]["requests"] - result["restart"]["pings"] != n or result["restart"]["pings"] >= n:
+        raise AssertionError("%(requests)d requests with %(pings)d pings are made after restart." % result["restart"])
+    return result
+
+
+@scenario
+def dispatch(bench):
+    '''
+    access of fluent actions like d.press.back, against the closure and wrapper
+    class built on every access before. "objects" is the number of distinct
+    dispatch objects returned by the accesses, i.e. allocations.
+    '''
+    d = bench.device()
+    obj = d(text="Item 0")
+    n = bench.options.iterations * 50
+
+    def legacy_scroll():
+        @uiautomator.param_to_property(
+            dimention=["vert", "vertically", "vertical", "horiz", "horizental", "horizentally"],
+            action=["forward", "backward", "toBeginning", "toEnd", "to", "iter"])
+        def _scroll(*args, **kwargs):
+            pass
+        return _scroll
+
+    result = {}
+    for name, access in [("legacy_scroll_horiz_forward", lambda: legacy_scroll().horiz.forward),
+                         ("scroll_horiz_forward", lambda: obj.scroll.horiz.forward),
+                         ("press_back", lambda: d.press.back),
+                         ("click", lambda: obj.click)]:
+        start = time.time()
+        for i in xrange(n):
+            access()
+        result[name] = {"us": (time.time() - start) / n * 1e6,
+                        "objects": len(set(id(action) for action in [access() for i in range(1000)]))}
+
+    # the action is the first positional argument as well as the attribute.
+    device = bench.adb.devices[d.serial]
+    device.history = []
+    try:
+        d.wait("idle")
+        d.wait("update", 500, "com.android.settings")
+        d.wait.idle(timeout=200)
+        calls = list(device.history)
+    finally:
+        device.history = None
+    expected = [("waitForIdle", [1000]), ("waitForWindowUpdate", ["com.android.settings", 500]),
+                ("waitForIdle", [200])]
+    if calls != expected:
+        raise AssertionError("wait calls %r instead of %r." % (calls, expected))
+    for args in [(), ("idle", 1000, "com.android.settings", 1)]:
+        try:
+            d.wait(*args)
+        except TypeError:
+            continue
+        raise AssertionError("wait%r is accepted." % (args,))
+    return result
+
+
+@scenario
+def selector_build(bench):
+    '''
+    build and serialize cost in microseconds, and bytes of exist() requests,
+    of compact compiled selectors, against the full dict copied on every
+    build before. "cold" builds include constructing the builder.
+    '''
+    n = bench.options.iterations * 50
+    cases = collections.OrderedDict([
+        ("simple", lambda: uiautomator.SelectorBuilder(text="Wi-Fi", className="android.widget.TextView")),
+        ("nested", lambda: uiautomator.SelectorBuilder(
+            className="android.widget.LinearLayout", instance=2,
+            childSelector=uiautomator.SelectorBuilder(resourceId="android:id/title", text="Wi-Fi"))),
+    ])
+
+    def legacy_build(builder):
+        d = builder._dict.copy()
+        for k in ["childSelector", "fromParent"]:
+            if d[k] is not None:
+                d[k] = legacy_build(d[k])
+        return d
+
+    def us(func):
+        start = time.time()
+        for i in xrange(n):
+            func()
+        return (time.time() - start) / n * 1e6
+
+    result = {}
+    for name, new in cases.items():
+        builder = new()
+        forms = [("legacy", lambda: legacy_build(builder), lambda: legacy_build(new())),
+                 ("compact", lambda: builder.build(), lambda: new().build()),
+                 ("full", lambda: builder.build(full=True), lambda: new().build(full=True))]
+        result[name] = {}
+        for form, build, cold in forms:
+            selector = build()
+            result[name][form] = {"build": us(build), "build_cold": us(cold),
+                                  "serialize": us(lambda: json.dumps(selector)),
+                                  "bytes": len(jsonrpclib.dumps((selector,), "exist"))}
+        compact, full = cases[name]().build(), cases[name]().build(full=True)
+        if set(compact) != set(uiautomator.SelectorBuilder.criteria(full)) | set(["mask"]) or \
+                result[name]["compact"]["bytes"] >= result[name]["full"]["bytes"]:
+            raise AssertionError("%s: compact selector %r is not the fields set in %r." % (name, compact, full))
+    return result
+
+
+# nodes in document order: 0 frame, 1 list, 2/5/8 rows, 3/6/9 titles, 4/7/10 switches, 11 footer.
+MATCHERS_XML = '''<?xml version='1.0' encoding='UTF-8' standalone='yes' ?><hierarchy rotation="0">
+<node index="0" class="android.widget.FrameLayout" package="com.android.settings">
+ <node index="0" class="android.widget.ListView" resource-id="android:id/list" scrollable="true">
+  <node index="0" class="android.widget.LinearLayout" clickable="true">
+   <node index="0" class="android.widget.TextView" resource-id="android:id/title" text="Wi-Fi"/>
+   <node index="1" class="android.widget.Switch" resource-id="android:id/switch" checked="true"/>
+  </node>
+  <node index="1" class="android.widget.LinearLayout" clickable="true">
+   <node index="0" class="android.widget.TextView" resource-id="android:id/title" text="Wi-Fi Direct"/>
+   <node index="1" class="android.widget.Switch" resource-id="android:id/switch" checked="false"/>
+  </node>
+  <node index="2" class="android.widget.LinearLayout" clickable="true">
+   <node index="0" class="android.widget.TextView" resource-id="android:id/title" text="Bluetooth"
+         content-desc="Bluetooth settings"/>
+   <node index="1" class="android.widget.Switch" resource-id="android:id/switch" checked="true"/>
+  </node>
+ </node>
+ <node index="1" class="android.widget.TextView" resource-id="com.android.settings:id/footer" text="Wi-Fi"/>
+</node>
+</hierarchy>'''
+
+
+@scenario
+def matchers(bench):
+    '''
+    selectors evaluated on a small fixed hierarchy, against nodes expected by
+    hand, on a local snapshot and by count() of ui objects on the device.
+    '''
+    S = uiautomator.SelectorBuilder
+    cases = [
+        (S(text="Wi-Fi"), [3, 11]),
+        (S(textContains="Wi-Fi"), [3, 6, 11]),
+        (S(textStartsWith="Wi-Fi D"), [6]),
+        (S(textMatches="Wi-Fi"), [3, 11]),  # the whole text matches
+        (S(textMatches="Wi.*"), [3, 6, 11]),
+        (S(textMatches="Fi"), []),
+        (S(description="Bluetooth settings"), [9]),
+        (S(descriptionContains="settings"), [9]),
+        (S(descriptionStartsWith="Bluetooth"), [9]),
+        (S(descriptionMatches="Blue.*"), [9]),
+        (S(className="android.widget.Switch", checked=True), [4, 10]),
+        (S(className="android.widget.Switch", index=1), [4, 7, 10]),
+        (S(classNameMatches=".*Layout"), [0, 2, 5, 8]),
+        (S(resourceIdMatches=".*:id/title"), [3, 6, 9]),
+        (S(packageName="com.android.settings"), [0]),
+        (S(scrollable=True), [1]),
+        (S(className="android.widget.Switch", instance=1), [7]),
+        (S(className="android.widget.Switch", instance=3), []),
+        (S(textContains="Wi-Fi", instance=2), [11]),
+        # childSelector matches descendants of each matched node, in its subtree only.
+        (S(scrollable=True, childSelector=S(text="Wi-Fi")), [3]),
+        (S(className="android.widget.FrameLayout", childSelector=S(text="Wi-Fi")), [3, 11]),
+        (S(clickable=True, childSelector=S(className="android.widget.Switch", checked=False)), [7]),
+        (S(clickable=True, instance=2, childSelector=S(resourceId="android:id/switch")), [10]),
+        (S(clickable=True, childSelector=S(text="Bluetooth", instance=0)), [9]),
+        # fromParent matches in the subtree of the parent of each matched node.
+        (S(text="Wi-Fi Direct", fromParent=S(className="android.widget.Switch")), [7]),
+        (S(resourceId="android:id/title", fromParent=S(checked=True)), [4, 10]),
+        (S(text="Wi-Fi", instance=0, fromParent=S(className="android.widget.Switch")), [4]),
+        (S(text="Wi-Fi", fromParent=S(className="android.widget.Switch")), [4, 7, 10]),  # footer's parent is frame
+        (S(resourceId="com.android.settings:id/footer", fromParent=S(text="Wi-Fi")), [3, 11]),
+    ]
+    snapshot = uiautomator._Snapshot(MATCHERS_XML)
+    if len(snapshot.nodes) != 12:
+        raise AssertionError("%d nodes are parsed instead of 12." % len(snapshot.nodes))
+    for selector, expected in cases:
+        found = [node.order for node in snapshot.find_all(selector)]
+        if found != expected:
+            raise AssertionError("%r finds nodes %r instead of %r." % (selector.build(), found, expected))
+
+    info = snapshot.info(text="Bluetooth")
+    if (info["contentDescription"], info["resourceName"], info["childCount"]) != \
+            ("Bluetooth settings", "android:id/title", 0):
+        raise AssertionError("unexpected info %r." % info)
+    if snapshot.info(clickable=True, instance=1)["childCount"] != 2:
+        raise AssertionError("the second row has no 2 children.")
+
+    d = bench.device()
+    device = bench.adb.devices[d.serial]
+    device.set_hierarchy(MATCHERS_XML)
+    try:
+        for selector, expected in cases:
+            criteria = uiautomator.SelectorBuilder.criteria(selector.build())
+            for name in ["childSelector", "fromParent"]:
+                if name in criteria:
+                    criteria[name] = uiautomator.SelectorBuilder.criteria(criteria[name])
+            obj = d(**dict((k, v) for k, v in criteria.items() if k not in ["childSelector", "fromParent"]))
+            if "childSelector" in criteria:
+                obj.child_selector(**criteria["childSelector"])
+            if "fromParent" in criteria:
+                obj.from_parent(**criteria["fromParent"])
+            if obj.count != len(expected) or obj.exist() != bool(expected):
+                raise AssertionError("%r counts %d objects instead of %d." % (criteria, obj.count, len(expected)))
+    finally:
+        device.set_hierarchy(fakedevice.hierarchy(bench.options.rows))
+    return {"cases": len(cases)}
+
+
+@scenario
+def selectors(bench):
+    '''selector heavy flow, via rpc, info cache, batch and local snapshot.'''
+    d = bench.device()
+    n = bench.options.iterations
+    rows = bench.options.rows
+
+    def obj(i):
+        return d(text="Item %d" % (i % rows), className="android.widget.TextView", resourceId="android:id/title",
+                 packageName="com.android.settings", enabled=True)
+
+    def fields(o):
+        return o.text, o.bounds, o.checked, o.enabled
+
+    result = {
+        "build": summarize(measure(lambda i: obj(i).selector, n)),
+        "exist": summarize(measure(lambda i: obj(i).exist(), n)),
+        "info_fields": summarize(measure(lambda i: fields(d(text="Item %d" % (i % rows))), n)),
+        "info_fields_cached": summarize(measure(lambda i: fields(d(text="Item %d" % (i % rows)).cache_info(1.0)), n)),
+    }
+
+    def batch(i):
+        with d.batch():
+            futures = [d(text="Item %d" % j).exist() for j in range(10)]
+        return [f.result() for f in futures]
+
+    result["batch_exist_10"] = summarize(measure(batch, max(n / 10, 1)))
+    for name, read in [("orientation", lambda: d.orientation), ("text", lambda: d(text="Item 0").text),
+                       ("dump", lambda: d.dump()), ("screenshot", lambda: d.screenshot()),
+                       ("count", lambda: d(text="Item 0").count),
+                       ("wait_any", lambda: d.wait.any(d(text="Item 0"), by="snapshot"))]:
+        try:
+            with d.batch():
+                read()
+        except RuntimeError:
+            continue
+        raise AssertionError("%s is read in a batch." % name)
+    snapshot = d.snapshot()
+    result["snapshot_exist"] = summarize(measure(lambda i: snapshot.exist(obj(i)), n))
+    result["snapshot"] = summarize(measure(lambda i: d.snapshot(), max(n / 10, 1)))
+    return result
+
+
+@scenario
+def enumerate_list(bench):
+    '''info of all checkboxes, per instance until not found, against all() by snapshot and by batch.'''
+    d = bench.device()
+    n = max(bench.options.iterations / 20, 1)
+    device = bench.adb.devices[d.serial]
+
+    def per_instance(i):
+        infos = []
+        while d(className="android.widget.CheckBox", instance=len(infos)).exist():
+            infos.append(d(className="android.widget.CheckBox", instance=len(infos)).info)
+        return infos
+
+    result = {"objects": len(per_instance(0))}
+    for name, func in [("per_instance", per_instance),
+                       ("all_snapshot", lambda i: [o.info for o in d(className="android.widget.CheckBox")]),
+                       ("all_batch", lambda i: [o.info for o in d(className="android.widget.CheckBox").all(by="batch")])]:
+        requests = device.requests
+        result[name] = summarize(measure(func, n))
+        result[name]["requests"] = (device.requests - requests) / n
+
+    expected = per_instance(0)
+    if len(expected) != bench.options.rows:
+        raise AssertionError("%d checkboxes are found instead of %d." % (len(expected), bench.options.rows))
+    for by in ["snapshot", "batch"]:
+        infos = [o.info for o in d(className="android.widget.CheckBox").all(by=by)]
+        if infos != expected:
+            raise AssertionError("all(by=%r) returns other infos than per instance." % by)
+        for obj in [d(className="android.widget.LinearLayout").child_selector(className="android.widget.CheckBox"),
+                    d(text="Item 0").from_parent(className="android.widget.CheckBox")]:
+            try:
+                obj.all(by=by)
+            except ValueError:
+                continue
+            raise AssertionError("all(by=%r) accepts %r." % (by, obj.selector))
+    return result
+
+
+@scenario
+def scroll_list(bench):
+    '''collect all rows of a long list, by scroll.iter against scroll forward and reading each row.'''
+    d = bench.device()
+    device = bench.adb.devices[d.serial]
+    rows, visible = bench.options.rows * 10, 12
+
+    def per_row(i):
+        device.set_list(rows, visible)
+        texts = set()
+        while True:
+            k = 0
+            while d(resourceId="android:id/title", instance=k).exist():
+                texts.add(d(resourceId="android:id/title", instance=k).info["text"])
+                k += 1
+            if not d(scrollable=True).scroll.vert.forward():
+                return texts
+
+    def scroll_iter(i):
+        device.set_list(rows, visible)
+        return [node["text"] for node in d(scrollable=True).scroll.iter(resourceId="android:id/title")]
+
+    result = {"rows": rows}
+    for name, func in [("per_row", per_row), ("scroll_iter", scroll_iter)]:
+        requests = device.requests
+        start = time.time()
+        collected = func(0)
+        if len(collected) != rows or len(set(collected)) != rows:
+            raise AssertionError("%s collects %d rows instead of %d." % (name, len(collected), rows))
+        result[name] = {"elapsed": (time.time() - start) * 1000, "requests": device.requests - requests}
+
+    # rows with the same title are items of their own.
+    device.set_list(5, visible, repeated=True)
+    repeated = len(list(d(scrollable=True).scroll.iter(resourceId="android:id/title")))
+    if repeated != 5:
+        raise AssertionError("scroll.iter yields %d of 5 identical rows." % repeated)
+    device.set_hierarchy(fakedevice.hierarchy(bench.options.rows))
+    return result
+
+
+@scenario
+def hierarchy_diff(bench):
+    '''
+    change detection on a large hierarchy: unchanged() and diff() of merkle
+    hashed snapshots, against comparing attributes of all nodes in order.
+    '''
+    rows = 1700  # 3 nodes per row, 5k+ nodes
+    n = max(bench.options.iterations / 10, 1)
+    xml = fakedevice.hierarchy(rows)
+    before = uiautomator._Snapshot(xml)
+    cases = collections.OrderedDict([
+        ("identical", (xml, 0)),
+        ("text_changed", (xml.replace('text="Item %d"' % (rows / 2), 'text="Item changed"'), 1)),
+        ("row_added", (fakedevice.hierarchy(rows + 1), 1)),
+        ("scrolled", (fakedevice.hierarchy(rows, first=1), None)),
+    ])
+    result = {"nodes": len(before.nodes),
+              "parse": summarize(measure(lambda i: uiautomator._Snapshot(xml), n))}
+    for name, (after_xml, expected) in cases.items():
+        after = uiautomator._Snapshot(after_xml)
+        changes = after.diff(before)
+        if expected is not None and len(changes) != expected:
+            raise AssertionError("%s: %r instead of %d changes." % (name, changes, expected))
+        result[name] = {
+            "unchanged": summarize(measure(lambda i: after.unchanged(before), n)),
+            "diff": summarize(measure(lambda i: after.diff(before), n)),
+            "compare_all": summarize(measure(
+                lambda i: [x.attrib for x in after.nodes] == [x.attrib for x in before.nodes], n)),
+            "changes": {"added": len(changes.added), "removed": len(changes.removed),
+                        "moved": len(changes.moved), "changed": len(changes.changed)}
+        }
+    return result
+
+
+@scenario
+def watchers(bench):
+    '''
+    popups dismissed by client side watchers: delay from the popup showing up
+    to the watcher acting, and rpc requests per pass of all watchers.
+    '''
+    d = bench.device()
+    device = bench.adb.devices[d.serial]
+    normal = fakedevice.hierarchy(bench.options.rows)
+    popup = normal.replace("</hierarchy>", '<node index="0" text="Rate this app" resource-id="" class="android.widget.TextView" '
+                                           'package="com.android.vending" content-desc="" bounds="[100,500][620,700]" />'
+                                           '</hierarchy>')
+    dismissed = threading.Event()
+
+    def dismiss():
+        device.set_hierarchy(normal)
+        dismissed.set()
+
+    d.watchers.start(interval=0.05)
+    for i in range(4):
+        d.watchers.register("never %d" % i, when=dict(text="Never %d" % i, mask=1))
+    d.watchers.register("rating", when=d(text="Rate this app"), do=dismiss)
+    delays = []
+    requests = device.requests
+    passes = d.watchers.passes
+    for i in range(5):
+        dismissed.clear()
+        device.set_hierarchy(popup)
+        start = time.time()
+        dismissed.wait(5)
+        delays.append(time.time() - start)
+        time.sleep(0.1)
+    result = {"watchers": len(d.watchers), "triggers": d.watchers.counts["rating"],
+              "delay": summarize(delays),
+              "requests_per_pass": float(device.requests - requests) / max(d.watchers.passes - passes, 1)}
+    d.watchers.stop()
+    d.watchers.remove()
+    return result
+
+
+@scenario
+def tail_latency(bench):
+    '''
+    reads of which every 10th stalls: latency without and with hedging, also
+    of threads sharing the device, and time to give up on a hung call under a
+    deadline.
+    '''
+    d = bench.device()
+    device = bench.adb.devices[d.serial]
+    n = max(bench.options.iterations, 20)
+    device.stalls["deviceInfo"] = (10, 0.2)
+    try:
+        plain = summarize(measure(lambda i: d.server.jsonrpc.deviceInfo(), n))
+        d.server.hedge_after = 0.02
+        hedged = summarize(measure(lambda i: d.server.jsonrpc.deviceInfo(), n))
+        samples = []
+        run_threads(lambda k: samples.extend(measure(lambda i: d.server.jsonrpc.deviceInfo(), n)),
+                    bench.options.threads)
+        hedged_threads = summarize(samples)
+        d.server.hedge_after = None
+        device.stalls["ping"] = (1, 0.5)
+
+        def hung(i):
+            try:
+                with uiautomator.deadline(0.1):
+                    d.server.jsonrpc.ping()
+            except uiautomator.DeadlineExceeded:
+                pass
+
+        deadline = summarize(measure(hung, 5))
+    finally:
+        d.server.hedge_after = None
+        device.stalls.clear()
+    return {"plain": plain, "hedged": hedged, "hedged_threads": hedged_threads, "deadline": deadline,
+            "counters": dict(d.server.counters)}
+
+
+@scenario
+def resend(bench):
+    '''
+    connections closed after the request is done but before the response.
+    Raise AssertionError if an action is done twice, or a read is not sent
+    again.
+    '''
+    d = bench.device()
+    device = bench.adb.devices[d.serial]
+    result = {}
+    for method, call in [("click", lambda: d.click(1, 2)), ("deviceInfo", lambda: d.server.jsonrpc.deviceInfo())]:
+        d.server.jsonrpc.ping()  # a kept-alive connection
+        calls = device.calls[method]
+        device.drops[method] += 1
+        try:
+            call()
+            result[method] = "ok"
+        except uiautomator._transport_errors as e:
+            result[method] = type(e).__name__
+        result[method + "_calls"] = device.calls[method] - calls
+    if result["click_calls"] != 1:
+        raise AssertionError("click is done %d times after the connection is closed." % result["click_calls"])
+    if result["deviceInfo"] != "ok":
+        raise AssertionError("deviceInfo is not sent again after the connection is closed.")
+    return result
+
+
+@scenario
+def dump_screenshot(bench):
+    '''throughput of dump inline and via device file, screenshot and capture stream.'''
+    d = bench.device()
+    n = max(bench.options.iterations / 10, 1)
+    device = bench.adb.devices[d.serial]
+    result = {}
+    for name, func, size in [("dump", lambda i: d.dump(), len(device.xml)),
+                             ("dump_file", lambda i: d.dump(inline=False), len(device.xml)),
+                             ("screenshot", lambda i: d.screenshot(), len(device.png))]:
+        samples = measure(func, n)
+        result[name] = summarize(samples)
+        result[name]["MBps"] = size * n / sum(samples) / 1024 / 1024
+    stream = d.capture_stream(fps=1000)
+    start = time.time()
+    for i, png in zip(range(n), stream):
+        pass
+    stream.close()
+    result["capture_stream"] = {"frames": n, "fps": n / (time.time() - start)}
+    return result
+
+
+@scenario
+def fanout(bench):
+    '''
+    the same calls on all devices, sequentially, with DevicePool and with
+    AsyncDevice, and concurrent coroutines sharing one AsyncDevice. Raise
+    AssertionError if their responses are mixed.
+    '''
+    calls = max(bench.options.iterations / 10, 1)
+    devices = [bench.device(serial) for serial in bench.serials]
+
+    def work(d):
+        for i in range(calls):
+            d.info
+            d(text="Item %d" % i).exist()
+
+    result = {"devices": len(devices), "calls_per_device": calls * 2}
+    start = time.time()
+    for d in devices:
+        work(d)
+    result["sequential"] = (time.time() - start) * 1000
+    pool = uiautomator.DevicePool(bench.serials)
+    pool.map(lambda d: d.info)  # attach to running servers
+    start = time.time()
+    pool.map(work)
+    result["device_pool"] = (time.time() - start) * 1000
+    if uiautomator.asyncio is not None:
+        asyncio, From = uiautomator.asyncio, uiautomator.From
+        loop = asyncio.get_event_loop()
+        async_devices = [uiautomator.AsyncDevice(serial, loop=loop) for serial in bench.serials]
+
+        @asyncio.coroutine
+        def async_work(d):
+            for i in range(calls):
+                yield From(d.info)
+                yield From(d(text="Item %d" % i).exist())
+
+        loop.run_until_complete(asyncio.gather(*[d.info for d in async_devices], loop=loop))
+        start = time.time()
+        loop.run_until_complete(asyncio.gather(*[async_work(d) for d in async_devices], loop=loop))
+        result["async"] = (time.time() - start) * 1000
+
+        d = async_devices[0]
+
+        @asyncio.coroutine
+        def read(i):
+            info = yield From(d(text="Item %d" % (i % bench.options.rows)).info)
+            raise uiautomator.Return(info["text"])
+
+        start = time.time()
+        texts = loop.run_until_complete(asyncio.gather(*[read(i) for i in range(calls * 2)], loop=loop))
+        result["async_shared"] = (time.time() - start) * 1000
+        if texts != ["Item %d" % (i % bench.options.rows) for i in range(calls * 2)]:
+            raise AssertionError("responses of coroutines sharing one AsyncDevice are mixed.")
+
+        # orientation is set by a coroutine method, and keyword arguments are sent as named params.
+        device = bench.adb.devices[d.server.serial]
+        device.history = []
+        try:
+            loop.run_until_complete(d.set_orientation("l"))
+            loop.run_until_complete(d.server.call("pressKey", key="home"))
+            calls = list(device.history)
+        finally:
+            device.history = None
+        if calls != [("setOrientation", ["left"]), ("pressKey", {"key": "home"})]:
+            raise AssertionError("unexpected calls %r of AsyncDevice." % calls)
+        try:
+            d.orientation = "l"
+        except AttributeError:
+            pass
+        else:
+            raise AssertionError("orientation of AsyncDevice is set without its coroutine.")
+    return result
+
+
+@scenario
+def concurrency(bench):
+    '''
+    threads sharing one device. Raise AssertionError if arguments of calls are
+    mixed across threads, or the server is started more than once.
+    '''
+    threads = bench.options.threads
+    calls = max(bench.options.iterations / threads, 1)
+    d = bench.device()
+    device = bench.adb.devices[d.serial]
+    keys = ["home", "back", "menu", "search", "enter", "recent", "up", "down"]
+    press = d.press  # one wrapper shared by all threads
+
+    def act(k):
+        for i in range(calls):
+            getattr(press, keys[k % len(keys)])()
+            d.click(k, i)
+
+    device.history = []
+    result = {"threads": threads, "calls_per_thread": calls * 2,
+              "actions": run_threads(act, threads) * 1000}
+    history, device.history = device.history, None
+    expected = [("pressKey", [keys[k % len(keys)]]) for k in range(threads) for i in range(calls)] + \
+               [("click", [k, i]) for k in range(threads) for i in range(calls)]
+    if sorted(json.dumps(call) for call in history) != sorted(json.dumps(call) for call in expected):
+        raise AssertionError("arguments of calls are mixed across threads.")
+
+    # reads of one device in parallel, against the same reads in one thread.
+    latency, device.latency = device.latency, max(device.latency, 0.002)
+    try:
+        sequential = run_threads(lambda k: [d.info for i in range(calls * threads)], 1)
+        parallel = run_threads(lambda k: [d(text="Item %d" % i).exist() for i in range(calls)], threads)
+    finally:
+        device.latency = latency
+    result.update(sequential=sequential * 1000, parallel=parallel * 1000, speedup=sequential / parallel)
+
+    # concurrent first calls start the server once.
+    serial = bench.serials[-1]
+    if serial in bench.devices:
+        bench.devices.pop(serial).server.stop(force=True)
+    fresh = uiautomator.Device(serial)
+    starts = []
+    fresh.server.hooks.append(lambda event: event.kind == "start" and starts.append(event))
+    result["first_calls"] = run_threads(lambda k: fresh.info, threads) * 1000
+    bench.devices[serial] = fresh
+    if len(starts) != 1:
+        raise AssertionError("server is started %d times by concurrent first calls." % len(starts))
+    return result
+
+
+class Bench(object):
+
+    '''fake devices and running uiautomator devices shared by scenarios.'''
+
+    def __init__(self, options):
+        self.options = options
+        self.serials = ["fake-%d" % i for i in range(options.devices)]
+        self.adb = fakedevice.FakeAdbServer([
+            fakedevice.FakeDevice(serial, latency=options.latency, launch_latency=options.launch_latency,
+                                  rows=options.rows, png_size=options.png_size) for serial in self.serials])
+        self.adb.install()
+        self.devices = {}
+
+    def device(self, serial=None):
+        serial = serial or self.serials[0]
+        if serial not in self.devices:
+            self.devices[serial] = uiautomator.Device(serial)
+            self.devices[serial].info  # start the server
+        return self.devices[serial]
+
+    def close(self):
+        for d in self.devices.values():
+            d.server.stop(force=True)
+        self.adb.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of uiautomator against fake devices.")
+    parser.add_argument("scenarios", nargs="*", help="scenarios to run, all by default: %s." % ", ".join(scenarios))
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of each rpc call on device.")
+    parser.add_argument("--launch-latency", type=float, default=0.5, help="seconds of rpc server launch.")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--starts", type=int, default=3, help="times of start/stop.")
+    parser.add_argument("--devices", type=int, default=4, help="number of fake devices.")
+    parser.add_argument("--rows", type=int, default=50, help="rows of the list in window hierarchy.")
+    parser.add_argument("--threads", type=int, default=8, help="threads sharing one device.")
+    parser.add_argument("--png-size", type=int, default=256 * 1024, help="bytes of screenshot.")
+    parser.add_argument("--output", help="json file of results, stdout by default.")
+    options = parser.parse_args(argv)
+    unknown = set(options.scenarios) - set(scenarios)
+    if unknown:
+        parser.error("unknown scenarios: %s" % ", ".join(sorted(unknown)))
+
+    # jars and leases are kept in a temporary directory, away from the real ones.
+    tempdir = tempfile.tempdir = tempfile.mkdtemp(prefix="uiautomator-bench-")
+    jars = os.path.join(tempdir, "jars")
+    os.mkdir(jars)
+    for name in uiautomator._jar_files:
+        data = os.urandom(64 * 1024)
+        with open(os.path.join(jars, name), "wb") as f:
+            f.write(data)
+        uiautomator._jar_files[name] = "file://" + os.path.join(jars, name)
+        uiautomator._jar_digests[name] = hashlib.sha1(data).hexdigest()
+
+    bench = Bench(options)
+    results = collections.OrderedDict()
+    try:
+        for name in options.scenarios or scenarios:
+            results[name] = scenarios[name](bench)
+            sys.stderr.write("%s done\n" % name)
+    finally:
+        bench.close()
+        shutil.rmtree(tempdir, True)
+
+    report = json.dumps({
+        "version": uiautomator.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "options": vars(options),
+        "results": results
+    }, indent=2)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(report)
+    else:
+        print report
+
+
+if __name__ == "__main__":
+    main()
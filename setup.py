@@ -19,8 +19,10 @@ setup(name='uiautomator',
       author_email='xiaocong@gmail.com',
       url='https://github.com/xiaocong/uiautomator',
       install_requires=requires,
+      extras_require={"async": ["trollius"]},
       py_modules=['uiautomator'],
       scripts=['uiautomator.py'],
+      entry_points={"console_scripts": ["uiautomator = uiautomator:main"]},
       license='MIT',
       platforms='any',
       classifiers=(
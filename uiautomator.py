@@ -5,17 +5,50 @@
 """
 
 import os
+import sys
 import urllib2
+import httplib
+import socket
+import select
+import xmlrpclib
 import subprocess
 import time
 import itertools
+import collections
+import errno
+import hashlib
+import threading
+import weakref
+import operator
+import re
+import struct
 import tempfile
+import json
+import base64
+import zlib
+import argparse
+import Queue
+import contextlib
+import StringIO
+import SocketServer
+from multiprocessing.pool import ThreadPool
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 
 try:
     import jsonrpclib
 except ImportError:
     pass
 
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    asyncio = None
+
 __version__ = "0.1.1"
 __author__ = "Xiaocong He"
 
@@ -23,9 +56,9 @@ __author__ = "Xiaocong He"
 def param_to_property(**props):
     class Wrapper(object):
 
-        def __init__(self, func):
+        def __init__(self, func, kwargs=None):
             self.func = func
-            self.kwargs = {}
+            self.kwargs = kwargs or {}
 
         def __getattribute__(self, attr):
             try:
@@ -33,17 +66,80 @@ def param_to_property(**props):
             except AttributeError:
                 for prop_name, prop_values in props.items():
                     if attr in prop_values and prop_name not in self.kwargs:
-                        self.kwargs[prop_name] = attr
-                        return self
+                        # a new wrapper instead of changing self, which may be shared by threads.
+                        return Wrapper(self.func, dict(self.kwargs, **{prop_name: attr}))
                 raise
 
         def __call__(self, *args, **kwargs):
             kwargs.update(self.kwargs)
-            self.kwargs = {}
             return self.func(*args, **kwargs)
     return Wrapper
 
 
+class _BoundAction(object):
+
+    '''
+    action bound to its owner, e.g. d.press. An attribute listed in props
+    selects the argument, e.g. d.press.back calls press(d, key="back"), and
+    the selected actions are cached, so fluent calls don't allocate.
+    '''
+
+    __slots__ = ["func", "owner", "lookup", "kwargs", "selected"]
+
+    def __init__(self, func, owner, lookup, kwargs):
+        self.func = func
+        self.owner = owner
+        self.lookup = lookup  # attribute: argument name
+        self.kwargs = kwargs  # selected arguments, never changed
+        self.selected = {}  # attribute: action with the argument selected
+
+    def __getattr__(self, attr):
+        action = self.selected.get(attr)
+        if action is None:
+            name = self.lookup.get(attr)
+            if name is None or name in self.kwargs:
+                raise AttributeError(attr)
+            kwargs = dict(self.kwargs)
+            kwargs[name] = attr
+            action = self.selected[attr] = _BoundAction(self.func, self.owner, self.lookup, kwargs)
+        return action
+
+    def __call__(self, *args, **kwargs):
+        if self.kwargs:
+            kwargs.update(self.kwargs)
+        return self.func(self.owner, *args, **kwargs)
+
+
+class _ActionProperty(object):
+
+    '''
+    non-data descriptor of an action method. The action is bound once per
+    owner and kept in the owner's __dict__, which takes precedence on later
+    accesses.
+    '''
+
+    def __init__(self, func, props):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+        self.lookup = dict((value, name) for name, values in props.items() for value in values)
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        action = instance.__dict__[self.__name__] = _BoundAction(self.func, instance, self.lookup, {})
+        return action
+
+
+def _action_property(**props):
+    '''
+    decorate a method as action property, e.g. with
+    @_action_property(key=["home", "back"]) on press(self, key), d.press.back()
+    is press(d, key="back"), and d.press(4) is press(d, 4).
+    '''
+    return lambda func: _ActionProperty(func, props)
+
+
 class _SelectorBuilder(object):
 
     """The class is to build parameters for UiSelector passed to Android device.
@@ -82,6 +178,7 @@ class _SelectorBuilder(object):
     def __init__(self, **kwargs):
         self._dict = {k: v[1] for k, v in self.__fields.items()}
         self._dict[self.__mask] = 0
+        self.__compiled = None
 
         for k, v in kwargs.items():
             if k in self.__fields:
@@ -94,31 +191,99 @@ class _SelectorBuilder(object):
         if k in self.__fields:
             self._dict[k] = v  # call the method in superclass
             self._dict[self.__mask] = self[self.__mask] | self.__fields[k][0]
+            self.__compiled = None
         else:
             raise ReferenceError("%s is not allowed." % k)
 
     def __delitem__(self, k):
         if k in self.__fields:
-            self[k] = self.__fields[k][1]
-            self[self.__mask] = self[self.__mask] & ~self.__fields[k][0]
-
-    def build(self):
-        d = self._dict.copy()
-        for k, v in d.items():
-            # if isinstance(v, SelectorBuilder):
-            # TODO workaround.
-            # something wrong in the module loader, likely SelectorBuilder was
-            # loaded as another type...
-            if k in ["childSelector", "fromParent"] and v is not None:
-                d[k] = v.build()
-        return d
+            self._dict[k] = self.__fields[k][1]
+            self._dict[self.__mask] = self[self.__mask] & ~self.__fields[k][0]
+            self.__compiled = None
+
+    def compile(self):
+        '''compile to immutable and hashable _Selector, which is memoized until the builder changes.'''
+        if self.__compiled is None:
+            mask = self._dict[self.__mask]
+            items = []
+            for k, (bit, default) in self.__fields.items():
+                if mask & bit:
+                    v = self._dict[k]
+                    # if isinstance(v, SelectorBuilder):
+                    # TODO workaround.
+                    # something wrong in the module loader, likely SelectorBuilder was
+                    # loaded as another type...
+                    if k in ["childSelector", "fromParent"] and v is not None:
+                        v = v.compile()
+                    items.append((k, v))
+            self.__compiled = _Selector(mask, tuple(sorted(items)))
+        return self.__compiled
+
+    def build(self, full=False):
+        '''
+        build parameters for UiSelector, only with fields set in mask, or
+        with all fields if full is True. Don't modify the returned dict,
+        which is shared until the builder changes.
+        '''
+        return self.compile().full() if full else self.compile().compact()
 
     def keys(self):
         return self.__fields.keys()
 
+    @classmethod
+    def criteria(cls, selector):
+        '''return fields set in mask of the built selector.'''
+        mask = selector[cls.__mask]
+        return dict((k, selector[k]) for k, v in cls.__fields.items() if mask & v[0])
+
+    @classmethod
+    def defaults(cls):
+        d = dict((k, v[1]) for k, v in cls.__fields.items())
+        d[cls.__mask] = 0
+        return d
+
 SelectorBuilder = _SelectorBuilder
 
 
+class _Selector(object):
+
+    '''compiled selector, fields set in mask and their values in sorted tuple.'''
+
+    __slots__ = ["mask", "items", "_hash", "_compact", "_full"]
+
+    def __init__(self, mask, items):
+        self.mask = mask
+        self.items = items
+        self._hash = hash((mask, items))
+        self._compact = self._full = None
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return isinstance(other, _Selector) and self.mask == other.mask and self.items == other.items
+
+    def __ne__(self, other):
+        return not self == other
+
+    def compact(self):
+        '''selector dict with only the fields set in mask.'''
+        if self._compact is None:
+            d = dict((k, v.compact() if isinstance(v, _Selector) else v) for k, v in self.items)
+            d["mask"] = self.mask
+            self._compact = d
+        return self._compact
+
+    def full(self):
+        '''selector dict with all fields, unset ones in default values.'''
+        if self._full is None:
+            d = _SelectorBuilder.defaults()
+            d.update((k, v.full() if isinstance(v, _Selector) else v) for k, v in self.items)
+            d["mask"] = self.mask
+            self._full = d
+        return self._full
+
+
 def rect(top=0, left=0, bottom=100, right=100):
     return {"top": top, "left": left, "bottom": bottom, "right": right}
 
@@ -127,6 +292,542 @@ def point(x=0, y=0):
     return {"x": x, "y": y}
 
 
+def _full_match(pattern, value):
+    return re.match("(?:%s)\\Z" % pattern, value, re.DOTALL) is not None
+
+
+_selector_matchers = {  # selector field: (node attribute, match function)
+    "text": ("text", operator.eq),
+    "textContains": ("text", operator.contains),
+    "textMatches": ("text", lambda value, pattern: _full_match(pattern, value)),
+    "textStartsWith": ("text", lambda value, prefix: value.startswith(prefix)),
+    "className": ("className", operator.eq),
+    "classNameMatches": ("className", lambda value, pattern: _full_match(pattern, value)),
+    "description": ("description", operator.eq),
+    "descriptionContains": ("description", operator.contains),
+    "descriptionMatches": ("description", lambda value, pattern: _full_match(pattern, value)),
+    "descriptionStartsWith": ("description", lambda value, prefix: value.startswith(prefix)),
+    "checkable": ("checkable", operator.eq),
+    "checked": ("checked", operator.eq),
+    "clickable": ("clickable", operator.eq),
+    "longClickable": ("longClickable", operator.eq),
+    "scrollable": ("scrollable", operator.eq),
+    "enabled": ("enabled", operator.eq),
+    "focusable": ("focusable", operator.eq),
+    "focused": ("focused", operator.eq),
+    "selected": ("selected", operator.eq),
+    "packageName": ("packageName", operator.eq),
+    "packageNameMatches": ("packageName", lambda value, pattern: _full_match(pattern, value)),
+    "resourceId": ("resourceId", operator.eq),
+    "resourceIdMatches": ("resourceId", lambda value, pattern: _full_match(pattern, value)),
+    "index": ("index", operator.eq)
+}
+
+_node_attributes = {  # attribute in hierarchy xml: (node attribute, parser)
+    "index": ("index", int),
+    "text": ("text", unicode),
+    "resource-id": ("resourceId", unicode),
+    "class": ("className", unicode),
+    "package": ("packageName", unicode),
+    "content-desc": ("description", unicode),
+    "checkable": ("checkable", lambda v: v == "true"),
+    "checked": ("checked", lambda v: v == "true"),
+    "clickable": ("clickable", lambda v: v == "true"),
+    "enabled": ("enabled", lambda v: v == "true"),
+    "focusable": ("focusable", lambda v: v == "true"),
+    "focused": ("focused", lambda v: v == "true"),
+    "scrollable": ("scrollable", lambda v: v == "true"),
+    "long-clickable": ("longClickable", lambda v: v == "true"),
+    "password": ("password", lambda v: v == "true"),
+    "selected": ("selected", lambda v: v == "true"),
+    "bounds": ("bounds", lambda v: dict(zip(("left", "top", "right", "bottom"), map(int, re.findall(r"-?\d+", v)))))
+}
+
+_node_content_attributes = sorted(name for name, parse in _node_attributes.values() if name not in ["index", "bounds"])
+
+_node_defaults = dict((name, parse("")) for name, parse in _node_attributes.values() if name not in ["index", "bounds"])
+_node_defaults.update(index=0, bounds=rect(0, 0, 0, 0))
+
+
+class _Node(object):
+
+    '''ui object node in the window hierarchy snapshot.'''
+
+    __slots__ = ["attrib", "parent", "children", "order", "end", "digest", "hash", "full_hash"]
+
+    def __init__(self, attrib, parent, order):
+        self.attrib = attrib
+        self.parent = parent
+        self.children = []
+        self.order = order  # index in document order
+        self.end = order  # document order of the last descendant
+        self.digest = self.hash = self.full_hash = None
+
+    def _seal(self):
+        '''
+        compute merkle hashes after children are parsed. digest is hash of own
+        attributes except position (index and bounds), hash is of digests in
+        the subtree, and full_hash also covers positions in the subtree.
+        '''
+        a = self.attrib
+        self.digest = hash(tuple(a[k] for k in _node_content_attributes))
+        self.hash = hash((self.digest, tuple(c.hash for c in self.children)))
+        self.full_hash = hash((self.hash, self.position, tuple(c.full_hash for c in self.children)))
+
+    @property
+    def position(self):
+        b = self.attrib["bounds"]
+        return self.attrib["index"], b["left"], b["top"], b["right"], b["bottom"]
+
+    @property
+    def key(self):
+        '''identity of node among its siblings, regardless of its content changes.'''
+        return self.attrib["className"], self.attrib["resourceId"]
+
+    def __getitem__(self, k):
+        return self.attrib[k]
+
+    def contains(self, node):
+        '''check if node is a descendant of the node.'''
+        return self.order < node.order <= self.end
+
+    @property
+    def info(self):
+        '''ui object info, in the same format as _AutomatorDeviceObject.info.'''
+        a = self.attrib
+        return {
+            "text": a["text"],
+            "className": a["className"],
+            "packageName": a["packageName"],
+            "contentDescription": a["description"],
+            "resourceName": a["resourceId"] or None,
+            "checkable": a["checkable"],
+            "checked": a["checked"],
+            "clickable": a["clickable"],
+            "enabled": a["enabled"],
+            "focusable": a["focusable"],
+            "focused": a["focused"],
+            "longClickable": a["longClickable"],
+            "scrollable": a["scrollable"],
+            "selected": a["selected"],
+            "bounds": dict(a["bounds"]),
+            "visibleBounds": dict(a["bounds"]),
+            "childCount": len(self.children)
+        }
+
+
+class _Snapshot(object):
+
+    '''
+    window hierarchy parsed from one dump, on which selectors are evaluated
+    locally. Nodes are indexed by text, resourceId, className, packageName
+    and description.
+    Usage:
+    s = d.snapshot()
+    s.exist(text="Settings")
+    s.count(className="android.widget.CheckBox")
+    s.info(d(text="Wi-Fi").from_parent(className="android.widget.Switch"))
+    s.find_all(resourceId="android:id/title")
+    '''
+
+    __indexed = ["text", "resourceId", "className", "packageName", "description"]
+
+    def __init__(self, xml):
+        self.xml = xml
+        self.nodes = []
+        self.__indexes = dict((name, {}) for name in self.__indexed)
+        self.__parse(_xml_bytes(xml))
+        self.roots = [n for n in self.nodes if n.parent is None]
+        self.hash = hash(tuple(n.full_hash for n in self.roots))
+
+    def unchanged(self, other):
+        '''check if the hierarchy is the same as other snapshot, in O(1).'''
+        return self.hash == other.hash
+
+    def diff(self, previous):
+        '''
+        return changes from the previous snapshot to this snapshot. Subtrees of
+        the same merkle hash are skipped without comparing their nodes.
+        '''
+        changes = _HierarchyDiff()
+        if not self.unchanged(previous):
+            _diff_nodes(previous.roots, self.roots, changes)
+            changes._pair_moved()
+        return changes
+
+    def __parse(self, xml):
+        '''
+        parse node elements under the root incrementally, and clear each
+        element once parsed, so memory of elements stays flat on huge dumps.
+        '''
+        parents = [None]
+        depth = skipped = 0  # skipped: depth in elements other than node
+        for event, element in ElementTree.iterparse(StringIO.StringIO(xml), events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    continue
+                if skipped or element.tag != "node":
+                    skipped += 1
+                    continue
+                attrib = dict(_node_defaults)
+                for k, v in element.attrib.items():
+                    if k in _node_attributes:
+                        name, parse = _node_attributes[k]
+                        attrib[name] = parse(v)
+                parent = parents[-1]
+                node = _Node(attrib, parent, len(self.nodes))
+                self.nodes.append(node)
+                if parent is not None:
+                    parent.children.append(node)
+                for name in self.__indexed:
+                    self.__indexes[name].setdefault(attrib[name], []).append(node)
+                parents.append(node)
+            else:
+                depth -= 1
+                if depth == 0:
+                    continue
+                element.clear()
+                if skipped:
+                    skipped -= 1
+                    continue
+                node = parents.pop()
+                node.end = len(self.nodes) - 1
+                node._seal()
+
+    def __candidates(self, criteria, scope):
+        candidates = None
+        for field, value in criteria.items():
+            name, match = _selector_matchers[field]
+            if name not in self.__indexes:
+                continue
+            index = self.__indexes[name]
+            if match is operator.eq:
+                nodes = index.get(value, [])
+            else:  # scan distinct values instead of all nodes.
+                nodes = [n for key, ns in index.items() if match(key, value) for n in ns]
+            if candidates is None or len(nodes) < len(candidates):
+                candidates = nodes
+        if candidates is None:
+            candidates = self.nodes if scope is None else self.nodes[scope.order + 1:scope.end + 1]
+        elif scope is not None:
+            candidates = [n for n in candidates if scope.contains(n)]
+        return sorted((n for n in candidates
+                       if all(_selector_matchers[field][1](n.attrib[_selector_matchers[field][0]], value)
+                              for field, value in criteria.items())),
+                      key=operator.attrgetter("order"))
+
+    def __find(self, selector, scope=None):
+        criteria = _SelectorBuilder.criteria(selector)
+        child = criteria.pop("childSelector", None)
+        sibling = criteria.pop("fromParent", None)
+        instance = criteria.pop("instance", None)
+        nodes = self.__candidates(criteria, scope)
+        if instance is not None:
+            nodes = nodes[instance:instance + 1]
+        if child is not None:
+            nodes = _union(self.__find(child, n) for n in nodes)
+        if sibling is not None:
+            nodes = _union(self.__find(sibling, n.parent) for n in nodes)
+        return nodes
+
+    def find_all(self, selector=None, **kwargs):
+        '''
+        return all nodes matching the selector, which may be a SelectorBuilder,
+        a ui object returned by d(...), a built selector, or keyword arguments.
+        '''
+        return self.__find(_build_selector(selector, **kwargs))
+
+    def exist(self, selector=None, **kwargs):
+        return len(self.find_all(selector, **kwargs)) > 0
+
+    def count(self, selector=None, **kwargs):
+        return len(self.find_all(selector, **kwargs))
+
+    def info(self, selector=None, **kwargs):
+        nodes = self.find_all(selector, **kwargs)
+        if not nodes:
+            raise LookupError("UiObject not found.")
+        return nodes[0].info
+
+
+class _HierarchyDiff(object):
+
+    '''
+    changes between two snapshots.
+    added: new nodes, whose subtrees are all added.
+    removed: old nodes, whose subtrees are all removed.
+    moved: (old, new) node pairs of the same subtree content at other position.
+    changed: (old, new) node pairs whose own attributes changed.
+    '''
+
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.moved = []
+        self.changed = []
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.moved) + len(self.changed)
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    def __repr__(self):
+        return "<HierarchyDiff added=%d removed=%d moved=%d changed=%d>" % (
+            len(self.added), len(self.removed), len(self.moved), len(self.changed))
+
+    def _pair_moved(self):
+        '''pair subtrees removed from one parent and added to another as moved.'''
+        removed = {}
+        for node in self.removed:
+            removed.setdefault(node.hash, []).append(node)
+        added = []
+        for node in self.added:
+            if removed.get(node.hash):
+                self.moved.append((removed[node.hash].pop(0), node))
+            else:
+                added.append(node)
+        self.added = added
+        self.removed = [n for nodes in removed.values() for n in nodes]
+        self.removed.sort(key=operator.attrgetter("order"))
+
+
+def _diff_nodes(old_nodes, new_nodes, changes):
+    matched, unmatched = set(), []
+    by_hash = {}
+    for node in old_nodes:
+        by_hash.setdefault(node.hash, []).append(node)
+    for node in new_nodes:  # same content of subtree
+        if by_hash.get(node.hash):
+            old = by_hash[node.hash].pop(0)
+            matched.add(old)
+            if old.full_hash != node.full_hash:
+                changes.moved.append((old, node))
+        else:
+            unmatched.append(node)
+    by_key = {}
+    for node in old_nodes:
+        if node not in matched:
+            by_key.setdefault(node.key, []).append(node)
+    for node in unmatched:  # same node, but its content changed
+        if by_key.get(node.key):
+            old = by_key[node.key].pop(0)
+            if old.digest != node.digest or old.position != node.position:
+                changes.changed.append((old, node))
+            _diff_nodes(old.children, node.children, changes)
+        else:
+            changes.added.append(node)
+    changes.removed.extend(n for nodes in by_key.values() for n in nodes)
+
+
+def _union(node_lists):
+    nodes = {}
+    for ns in node_lists:
+        for n in ns:
+            nodes[n.order] = n
+    return [nodes[k] for k in sorted(nodes)]
+
+
+def _xml_bytes(xml):
+    return xml.encode("utf-8") if isinstance(xml, unicode) else xml
+
+
+def _build_selector(selector=None, **kwargs):
+    if selector is None:
+        return SelectorBuilder(**kwargs).build()
+    elif isinstance(selector, dict):
+        return selector
+    elif isinstance(selector, _SelectorBuilder):
+        return selector.build()
+    else:  # _AutomatorDeviceObject
+        return selector.selector
+
+
+class CallEvent(object):
+
+    '''
+    report of one rpc call or adb command to hooks.
+    kind: "rpc", "batch", "ping", "start", "adb" (adb helpers) or "adb_cmd" (adb processes).
+    name: rpc method or adb command.
+    start, duration: wall time in seconds.
+    sent, received: bytes of request and response, None if unknown.
+    connected: True if a new connection was made for the call.
+    error: exception raised, None if succeeded.
+    '''
+
+    __slots__ = ["kind", "name", "serial", "start", "duration", "sent", "received", "connected", "error", "thread"]
+
+    def __init__(self, kind, name, serial=None):
+        self.kind = kind
+        self.name = name
+        self.serial = serial
+        self.start = time.time()
+        self.duration = None
+        self.sent = self.received = None
+        self.connected = False
+        self.error = None
+        self.thread = threading.current_thread().ident
+
+    def __repr__(self):
+        return "<CallEvent %s:%s %.3fms%s>" % (self.kind, self.name, (self.duration or 0) * 1000,
+                                               " error" if self.error is not None else "")
+
+
+_hooks = []  # hooks of all rpc calls and adb commands, see add_hook.
+
+
+def add_hook(hook):
+    '''
+    add hook, which is called with a CallEvent after every rpc call and adb
+    command. Hooks are called in the calling thread, and should not raise.
+    Hooks of only one server could be added to its hooks list.
+    '''
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def _emit(hooks, event):
+    event.duration = time.time() - event.start
+    for hook in hooks:
+        hook(event)
+
+
+def _observe(hooks, event, func, *args, **kwargs):
+    '''call func, and report the event to hooks.'''
+    try:
+        result = func(*args, **kwargs)
+        if isinstance(result, basestring):
+            event.received = len(result)
+        return result
+    except Exception as e:
+        event.error = e
+        raise
+    finally:
+        _emit(hooks, event)
+
+
+def _observed_adb(func):
+    '''report calls of the adb helper to hooks, if any.'''
+    name = func.__name__[len("adb_"):]
+
+    def wrapper(*args, **kwargs):
+        if not _hooks:
+            return func(*args, **kwargs)
+        return _observe(_hooks, CallEvent("adb", name, kwargs.get("serial")), func, *args, **kwargs)
+    wrapper.__name__, wrapper.__doc__ = func.__name__, func.__doc__
+    return wrapper
+
+
+class _ObservedPopen(subprocess.Popen):
+
+    '''adb process, which reports its event to hooks once it exits.'''
+
+    def __init__(self, hooks, event, *args, **kwargs):
+        self.__hooks, self.__event = hooks, event
+        super(_ObservedPopen, self).__init__(*args, **kwargs)
+
+    def __exited(self):
+        event, self.__event = self.__event, None
+        if event is not None:
+            if self.returncode != 0:
+                event.error = EnvironmentError("adb exited with code %d." % self.returncode)
+            _emit(self.__hooks, event)
+
+    def poll(self):
+        returncode = super(_ObservedPopen, self).poll()
+        if returncode is not None:
+            self.__exited()
+        return returncode
+
+    def wait(self):
+        returncode = super(_ObservedPopen, self).wait()
+        self.__exited()
+        return returncode
+
+
+class DeadlineExceeded(Exception):
+
+    '''rpc call or adb operation is not finished before its deadline.'''
+
+
+_deadlines = threading.local()
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    '''
+    bound rpc calls and adb operations in the with block of this thread to
+    finish in seconds, or DeadlineExceeded is raised. Nested scopes can only
+    shorten the deadline, and None adds no bound.
+    Usage:
+    with deadline(10):
+        d(text="Settings").click()
+        d.dump()
+    '''
+    if seconds is None:
+        yield
+        return
+    stack = _deadlines.__dict__.setdefault("stack", [])
+    until = time.time() + seconds
+    stack.append(min(until, stack[-1]) if stack else until)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def _remaining(timeout=None):
+    '''
+    seconds left to the deadline of the scope, and at most timeout, None if
+    unbounded. Raise DeadlineExceeded if the deadline has passed.
+    '''
+    stack = getattr(_deadlines, "stack", None)
+    if not stack:
+        return timeout
+    left = stack[-1] - time.time()
+    if left <= 0:
+        raise DeadlineExceeded("Deadline exceeded.")
+    return left if timeout is None else min(left, timeout)
+
+
+def _communicate(process, timeout=None):
+    '''communicate with the adb process, and kill it if not exited before the deadline.'''
+    timeout = _remaining(timeout)
+    if timeout is None:
+        return process.communicate()
+    result = []
+    thread = threading.Thread(target=lambda: result.append(process.communicate()))
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        process.kill()
+        thread.join(1)  # children of the killed shell may still hold the pipes.
+        raise DeadlineExceeded("adb process is not exited in %.3f seconds." % timeout)
+    return result[0]
+
+
+def _wait(process, timeout=None):
+    '''wait for the adb process to exit before the deadline, and return its exit code.'''
+    _communicate(process, timeout)
+    return process.returncode
+
+
+def _adb_timeout(func):
+    '''raise DeadlineExceeded instead of socket.timeout, from which adb helpers should not fall back to adb process.'''
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except socket.timeout:
+            raise DeadlineExceeded("adb %s is not finished before the deadline." % func.__name__)
+    wrapper.__name__, wrapper.__doc__ = func.__name__, func.__doc__
+    return wrapper
+
+
 _adb_cmd = None
 
 
@@ -139,22 +840,235 @@ def get_adb():
                 raise EnvironmentError(
                     "Adb not found in $ANDROID_HOME path: %s." % os.environ["ANDROID_HOME"])
         else:
-            import distutils
+            import distutils.spawn
             _adb_cmd = distutils.spawn.find_executable("adb")
             if _adb_cmd is not None:
-                _adb_cmd = os.path.realpath(cmd)
+                _adb_cmd = os.path.realpath(_adb_cmd)
             else:
                 raise EnvironmentError("$ANDROID_HOME environment not set.")
     return _adb_cmd
 
 
-def adb_cmd(*args):
-    return subprocess.Popen(["%s %s" % (get_adb(), " ".join(args))], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+def adb_cmd(*args, **kwargs):
+    '''run adb command, on the device of serial if given.'''
+    serial = kwargs.get("serial")
+    if serial:
+        args = ("-s", serial) + args
+    cmd = ["%s %s" % (get_adb(), " ".join(args))]
+    if _hooks:
+        name = args[2] if serial else args[0]
+        return _ObservedPopen(list(_hooks), CallEvent("adb_cmd", name, serial), cmd, shell=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def _recv_exactly(sock, size):
+    data = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            break
+        data.append(chunk)
+        size -= len(chunk)
+    return "".join(data)
+
+
+class AdbClient(object):
+
+    '''
+    client of adb host protocol, which talks to adb server socket directly
+    instead of spawning adb process.
+    '''
+
+    def __init__(self, serial=None, host="localhost", port=None, timeout=None):
+        self.serial = serial
+        self.host = host
+        self.port = port or int(os.environ.get("ANDROID_ADB_SERVER_PORT", 5037))
+        self.timeout = timeout  # seconds of each operation, None to wait until the deadline of the scope if any.
+
+    def __connect(self):
+        return socket.create_connection((self.host, self.port), _remaining(self.timeout))
+
+    def __check_status(self, sock, status=None):
+        status = status or _recv_exactly(sock, 4)
+        if status == "FAIL":
+            raise EnvironmentError("adb: %s" % _recv_exactly(sock, int(_recv_exactly(sock, 4), 16)))
+        elif status != "OKAY":
+            raise EnvironmentError("adb: unexpected status %r." % status)
+
+    def __request(self, sock, request):
+        sock.sendall("%04x%s" % (len(request), request))
+        self.__check_status(sock)
+
+    def __host_request(self, request):
+        sock = self.__connect()
+        try:
+            self.__request(sock, request)
+            return _recv_exactly(sock, int(_recv_exactly(sock, 4), 16))
+        finally:
+            sock.close()
+
+    def __service(self, service):
+        sock = self.__connect()
+        try:
+            self.__request(sock, "host:transport:%s" % self.serial if self.serial else "host:transport-any")
+            self.__request(sock, service)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    @_adb_timeout
+    def devices(self):
+        '''return dict of serial to state of attached devices.'''
+        return dict(line.split() for line in self.__host_request("host:devices").splitlines() if line.strip())
+
+    @_adb_timeout
+    def forward(self, local_port, device_port):
+        prefix = "host-serial:%s" % self.serial if self.serial else "host"
+        sock = self.__connect()
+        try:
+            self.__request(sock, "%s:forward:tcp:%d;tcp:%d" % (prefix, local_port, device_port))
+            status = _recv_exactly(sock, 4)  # newer adb server replies OKAY twice.
+            if status:
+                self.__check_status(sock, status)
+        finally:
+            sock.close()
+
+    @_adb_timeout
+    def forwards(self):
+        '''return list of (serial, local, remote) of all forwards.'''
+        return _parse_forwards(self.__host_request("host:list-forward"))
+
+    @_adb_timeout
+    def shell(self, *args):
+        '''run shell command on device, and return its output.'''
+        sock = self.__service("shell:%s" % " ".join(args))
+        try:
+            data = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    return "".join(data)
+                data.append(chunk)
+        finally:
+            sock.close()
+
+    @_adb_timeout
+    def sync(self):
+        '''open a sync session, which transfers files over one connection.'''
+        return _AdbSync(self.__service("sync:"))
+
+    def stat(self, path):
+        '''return (mode, size, mtime) of the file on device, mode is 0 if not exist.'''
+        with self.sync() as sync:
+            return sync.stat(path)
+
+    def push(self, local, remote, mode=None):
+        '''push local file to the remote file path on device.'''
+        with self.sync() as sync:
+            sync.push(local, remote, mode)
+
+    def pull(self, remote, local=None):
+        '''pull the remote file to local file, or return its content if local is None.'''
+        with self.sync() as sync:
+            return sync.pull(remote, local)
+
+
+class _AdbSync(object):
+
+    '''session of adb sync service.'''
+
+    def __init__(self, sock):
+        self.__sock = sock
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __send(self, cmd, arg):
+        self.__sock.sendall(struct.pack("<4sI", cmd, len(arg)) + arg)
+
+    def __bound(self):
+        '''bound the next operation by the deadline of the scope.'''
+        self.__sock.settimeout(_remaining())
+
+    def __recv(self, size):
+        return _recv_exactly(self.__sock, size)
+
+    def close(self):
+        try:
+            self.__send("QUIT", "")
+        except socket.error:
+            pass
+        finally:
+            self.__sock.close()
+
+    @_adb_timeout
+    def stat(self, path):
+        '''return (mode, size, mtime) of the file on device, mode is 0 if not exist.'''
+        self.__bound()
+        self.__send("STAT", path)
+        cmd, mode, size, mtime = struct.unpack("<4sIII", self.__recv(16))
+        if cmd != "STAT":
+            raise EnvironmentError("adb: unexpected sync response %r." % cmd)
+        return mode, size, mtime
+
+    @_adb_timeout
+    def push(self, local, remote, mode=None):
+        '''push local file to the remote file path on device, keeping its mtime.'''
+        self.__bound()
+        st = os.stat(local)
+        self.__send("SEND", "%s,%d" % (remote, st.st_mode if mode is None else mode))
+        with open(local, "rb") as f:
+            while True:
+                chunk = f.read(_sync_data_max)
+                if not chunk:
+                    break
+                self.__send("DATA", chunk)
+        self.__sock.sendall(struct.pack("<4sI", "DONE", int(st.st_mtime)))
+        cmd, length = struct.unpack("<4sI", self.__recv(8))
+        if cmd == "FAIL":
+            raise EnvironmentError("adb: %s" % self.__recv(length))
+
+    @_adb_timeout
+    def pull(self, remote, local=None):
+        '''pull the remote file to local file, or return its content if local is None.'''
+        self.__bound()
+        self.__send("RECV", remote)
+        data = []
+        while True:
+            cmd, length = struct.unpack("<4sI", self.__recv(8))
+            if cmd == "DATA":
+                data.append(self.__recv(length))
+            elif cmd == "DONE":
+                break
+            elif cmd == "FAIL":
+                raise EnvironmentError("adb: %s" % self.__recv(length))
+            else:
+                raise EnvironmentError("adb: unexpected sync response %r." % cmd)
+        if local is None:
+            return "".join(data)
+        with open(local, "wb") as f:
+            f.writelines(data)
+        return local
+
+
+_sync_data_max = 64 * 1024
 
 
+@_observed_adb
 def adb_devices():
     '''check if device is attached.'''
-    out = adb_cmd("devices").communicate()[0]
+    try:
+        return AdbClient().devices()
+    except socket.error:  # adb server is not running, let adb start it.
+        return _parse_devices(_communicate(adb_cmd("devices"))[0])
+
+
+def _parse_devices(out):
     match = "List of devices attached"
     index = out.find(match)
     if index < 0:
@@ -162,177 +1076,1437 @@ def adb_devices():
     return dict([s.split() for s in out[index + len(match):].strip().splitlines()])
 
 
-def adb_forward(local_port, device_port):
-    adb_cmd("forward", "tcp:%d" % local_port, "tcp:%d" % device_port).wait()
+def _check_attached(devices, serial):
+    if serial is not None and serial not in devices:
+        raise EnvironmentError("Device %s not attached." % serial)
+    elif len(devices) is 0:
+        raise EnvironmentError("Device not attached.")
+    elif len(devices) > 1 and serial is None:
+        raise EnvironmentError(
+            "Multiple devices attaches but $ANDROID_SERIAL environment not set.")
+
+
+@_observed_adb
+def adb_forward(local_port, device_port, serial=None):
+    try:
+        AdbClient(serial).forward(local_port, device_port)
+    except socket.error:
+        _wait(adb_cmd("forward", "tcp:%d" % local_port, "tcp:%d" % device_port, serial=serial))
+
+
+@_observed_adb
+def adb_forwards(serial=None):
+    '''return list of (local_port, device_port) of tcp forwards of the device.'''
+    try:
+        forwards = AdbClient().forwards()
+    except socket.error:
+        forwards = _parse_forwards(_communicate(adb_cmd("forward", "--list"))[0])
+    return [(int(local[4:]), int(remote[4:])) for s, local, remote in forwards
+            if (serial is None or s == serial) and local.startswith("tcp:") and remote.startswith("tcp:")]
+
+
+def _parse_forwards(out):
+    return [tuple(line.split()) for line in out.splitlines() if len(line.split()) == 3]
+
+
+@_observed_adb
+def adb_shell(*args, **kwargs):
+    '''run shell command on device, and return its output.'''
+    serial = kwargs.get("serial")
+    try:
+        return AdbClient(serial).shell(*args)
+    except socket.error:
+        return _communicate(adb_cmd("shell", *args, serial=serial))[0]
+
+
+@_observed_adb
+def adb_push(local, remote, serial=None):
+    '''push local file to remote path on device, return True if succeeded.'''
+    try:
+        AdbClient(serial).push(local, remote)
+    except socket.error:
+        return _wait(adb_cmd("push", local, remote, serial=serial)) is 0
+    except EnvironmentError:
+        return False
+    return True
+
+
+@_observed_adb
+def adb_read(remote, serial=None):
+    '''return content of remote file on device, None if failed.'''
+    try:
+        return AdbClient(serial).pull(remote)
+    except socket.error:
+        fd, local = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            if _wait(adb_cmd("pull", remote, local, serial=serial)) is 0:
+                with open(local, "rb") as f:
+                    return f.read()
+        finally:
+            os.remove(local)
+    except EnvironmentError:
+        return None
+
+
+@_observed_adb
+def adb_pull(remote, local, serial=None):
+    '''pull remote file on device to local file, return True if succeeded.'''
+    try:
+        AdbClient(serial).pull(remote, local)
+    except socket.error:
+        return _wait(adb_cmd("pull", remote, local, serial=serial)) is 0
+    except EnvironmentError:
+        return False
+    return True
+
+
+_allocated_ports = set()
+_allocated_ports_lock = threading.Lock()
+
+
+def next_local_port():
+    '''allocate a free local port for adb forward.'''
+    while True:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.bind(("localhost", 0))
+            port = s.getsockname()[1]
+        finally:
+            s.close()
+        with _allocated_ports_lock:
+            if port not in _allocated_ports:
+                _allocated_ports.add(port)
+                return port
 
 
-class _AutomatorServer(object):
+class _JsonRpcTransport(object):
 
-    """start and quit rpc server on device.
-    """
-    __jar_files = {
-        "bundle.jar": 'https://github.com/xiaocong/android-uiautomator-jsonrpcserver/blob/release/dist/bundle.jar?raw=true',
-        "uiautomator-stub.jar": "https://github.com/xiaocong/android-uiautomator-jsonrpcserver/blob/release/dist/uiautomator-stub.jar?raw=true"
-    }
+    '''
+    HTTP/1.1 keep-alive transport for jsonrpclib. Each thread reuses its own
+    connection across calls, so calls from threads run in parallel.
+    '''
 
     def __init__(self):
-        self.__automator_process = None
-        self.__local_port = 9008
-        self.__device_port = 9008
+        self.__local = threading.local()  # host, conn, sent, received and connects of the thread
+        self.__conns = weakref.WeakSet()  # connections of all threads
+        self.__lock = threading.Lock()
+        self.session = None  # recorder or replayer of the session
 
-    def __get__(self, instance, owner):
-        return self
+    @property
+    def sent(self):
+        '''bytes of the last request in this thread.'''
+        return getattr(self.__local, "sent", 0)
 
-    def __download_and_push(self):
-        lib_path = os.path.join(tempfile.gettempdir(), "libs")
-        if not os.path.exists(lib_path):
-            os.mkdir(lib_path)
-        for jar in self.__jar_files:
-            jarfile = os.path.join(lib_path, jar)
-            if not os.path.exists(jarfile):  # not exist, then download it
-                u = urllib2.urlopen(self.__jar_files[jar])
-                with open(jarfile, 'w') as f:
-                    f.write(u.read())
-            # push to device
-            adb_cmd("push", jarfile, "/data/local/tmp/").wait()
-        return self.__jar_files.keys()
-
-    def __adb_forward(self, local_port, device_port):
-        adb_cmd("forward", "tcp:%d" %
-                local_port, "tcp:%d" % device_port).wait()
+    @property
+    def received(self):
+        '''bytes of the last response in this thread.'''
+        return getattr(self.__local, "received", 0)
 
     @property
-    def jsonrpc(self):
-        if not self.alive:  # start server if not
-            self.start()
-        return jsonrpclib.Server(self.rpc_uri)
+    def connects(self):
+        '''number of connections made in this thread.'''
+        return getattr(self.__local, "connects", 0)
 
-    def start(self, local_port=9008, device_port=9008): #TODO add customized local remote port.
-        self.__local_port = local_port
-        self.__device_port = device_port
-        devices = adb_devices()
-        if len(devices) is 0:
-            raise EnvironmentError("Device not attached.")
-        elif len(devices) > 1 and "ANDROID_SERIAL" not in os.environ:
-            raise EnvironmentError(
-                "Multiple devices attaches but $ANDROID_SERIAL environment not set.")
-
-        files = self.__download_and_push()
-        cmd = ["shell", "uiautomator", "runtest"] + \
-            files + ["-c", "com.github.uiautomatorstub.Stub"]
-        self.__automator_process = adb_cmd(*cmd)
-        adb_forward(local_port, 9008)  # TODO device_port, currently only 9008
-        while not self.__can_ping():
-            time.sleep(0.1)
+    @property
+    def timeout(self):
+        '''seconds of socket operations of requests in this thread, None to block.'''
+        return getattr(self.__local, "timeout", None)
 
-    def __can_ping(self):
-        try:
-            return jsonrpclib.Server(self.rpc_uri).ping() == "pong" # not use self.jsonrpc here to avoid recursive invoke
-        except:
-            return False
+    @timeout.setter
+    def timeout(self, timeout):
+        self.__local.timeout = timeout
 
     @property
-    def alive(self):
-        '''Check if the rpc server is alive.'''
-        return self.__can_ping()
+    def idempotent(self):
+        '''whether requests of this thread may be sent again after they were written.'''
+        return getattr(self.__local, "idempotent", False)
 
-    def stop(self):
-        '''Stop the rpc server.'''
-        if self.__automator_process is not None and self.__automator_process.poll() is None:
-            try:
-                urllib2.urlopen(self.stop_uri)
-                self.__automator_process.wait()
-            except:
-                self.__automator_process.kill()
-            finally:
-                self.__automator_process = None
-        out = adb_cmd("shell", "ps", "-C", "uiautomator").communicate()[
-            0].strip().splitlines()
-        index = out[0].split().index("PID")
-        for line in out[1:]:
-            adb_cmd("shell", "kill", "-9", line.split()[index]).wait()
+    @idempotent.setter
+    def idempotent(self, idempotent):
+        self.__local.idempotent = idempotent
 
     @property
-    def stop_uri(self):
-        return "http://localhost:%d/stop" % self.__local_port
+    def attempt(self):
+        '''_Attempt of the hedged read of this thread, None if not hedged.'''
+        return getattr(self.__local, "attempt", None)
+
+    @attempt.setter
+    def attempt(self, attempt):
+        self.__local.attempt = attempt
 
     @property
-    def rpc_uri(self):
-        return "http://localhost:%d/jsonrpc/device" % self.__local_port
+    def written(self):
+        '''whether the last request of this thread was written to the server, even if it failed.'''
+        return getattr(self.__local, "written", False)
+
+    def request(self, host, handler, request_body, verbose=0):
+        '''post the request body and return the response body.'''
+        if self.session is not None:
+            return self.session.rpc(request_body, lambda: self.__request(host, handler, request_body))
+        return self.__request(host, handler, request_body)
+
+    def __connection(self, host):
+        local = self.__local
+        conn = getattr(local, "conn", None)
+        if conn is None or local.host != host:
+            if conn is not None:
+                conn.close()
+            conn = local.conn = httplib.HTTPConnection(host)
+            local.host = host
+            with self.__lock:
+                self.__conns.add(conn)
+        return conn
+
+    def __request(self, host, handler, request_body):
+        local = self.__local
+        attempt = self.attempt
+        for retry in (False, True):
+            conn = self.__connection(host)
+            if conn.sock is not None and _closed_by_peer(conn.sock):
+                conn.close()
+            reused = conn.sock is not None
+            if not reused:
+                local.connects = self.connects + 1
+            conn.timeout = self.timeout
+            if reused:
+                conn.sock.settimeout(conn.timeout)
+            local.sent, local.received, local.written = len(request_body), 0, False
+            try:
+                if attempt is not None:
+                    if conn.sock is None:
+                        conn.connect()
+                    attempt.bind(conn)
+                conn.putrequest("POST", handler, skip_accept_encoding=True)
+                conn.putheader("Accept-Encoding", "gzip, deflate")
+                conn.putheader("Content-Type", "application/json-rpc")
+                conn.putheader("Content-Length", str(len(request_body)))
+                conn.endheaders(request_body)
+                local.written = True
+                if attempt is not None:
+                    attempt.wait_response(conn)
+                response = conn.getresponse()
+                body = response.read()
+            except socket.timeout:
+                conn.close()  # the response may still come, so the connection can't be reused.
+                raise DeadlineExceeded("No response of %s in %.3f seconds." % (host + handler, conn.timeout))
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if attempt is not None and attempt.aborted:
+                    raise _Aborted("The other attempt of %s has won." % (host + handler))
+                # a kept-alive connection may have been closed by the server
+                # (e.g. server restarted), so retry once on a new connection,
+                # unless an action has been written and may have been done.
+                if retry or not reused or (local.written and not self.idempotent):
+                    raise
+                continue
+            finally:
+                if attempt is not None:
+                    attempt.release()
+            if response.status != 200:
+                raise xmlrpclib.ProtocolError(host + handler, response.status,
+                                              response.reason, response.msg)
+            local.received = len(body)
+            return _decode_content(body, response.getheader("Content-Encoding"))
 
+    def close(self):
+        '''close connections of all threads, which reconnect on next request.'''
+        with self.__lock:
+            conns = list(self.__conns)
+        for conn in conns:
+            conn.close()
 
-class _AutomatorDevice(object):
 
-    '''uiautomator wrapper of android device'''
-    server = _AutomatorServer()
+def _closed_by_peer(sock):
+    '''whether the idle kept-alive socket has been closed by the server, which makes it readable.'''
+    try:
+        return bool(select.select([sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
 
-    _orientation = (  # device orientation
-        (0, "natural", "n", 0),
-        (1, "left", "l", 90),
-        (2, "upsidedown", "u", 180),
-        (3, "right", "r", 270)
-    )
 
-    def __init__(self):
-        pass
+class _Aborted(Exception):
 
-    def __call__(self, **kwargs):
-        return _AutomatorDeviceObject(self.server.jsonrpc, **kwargs)
+    '''the attempt of a hedged read is aborted, since the other attempt has won.'''
 
-    def ping(self):
-        '''ping the device, by default it returns "pong".'''
-        return self.server.jsonrpc.ping()
 
-    @property
-    def info(self):
-        '''Get the device info.'''
-        return self.server.jsonrpc.deviceInfo()
+class _Attempt(object):
 
-    def click(self, x, y):
-        '''click at arbitrary coordinates.'''
-        self.server.jsonrpc.click(x, y)
+    '''
+    one of the two attempts of a hedged read. on_slow is called if there is
+    no response in delay seconds, and the loser is aborted by the winner from
+    another thread, which shuts down its socket.
+    '''
 
-    def swipe(self, sx, sy, ex, ey, steps=100):
-        return self.server.jsonrpc.swipe(sx, sy, ex, ey, steps)
+    def __init__(self, delay=None, on_slow=None):
+        self.delay, self.on_slow = delay, on_slow
+        self.aborted = False
+        self.__conn = None
+        self.__lock = threading.Lock()
+
+    def bind(self, conn):
+        '''the connected connection which the request is going to be sent on.'''
+        with self.__lock:
+            self.__conn = conn
+            aborted = self.aborted
+        if aborted:
+            raise _Aborted("The other attempt has won.")
+
+    def release(self):
+        '''the request is done, so its connection can be reused by other requests.'''
+        with self.__lock:
+            self.__conn = None
+
+    def wait_response(self, conn):
+        if self.on_slow is not None and not select.select([conn.sock], [], [], self.delay)[0]:
+            self.on_slow()
+
+    def abort(self):
+        with self.__lock:
+            self.aborted = True
+            sock = self.__conn.sock if self.__conn is not None else None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
 
-    def drag(self, sx, sy, ex, ey, steps=100):
-        '''Swipe from one point to another point.'''
-        return self.server.jsonrpc.drag(sx, sy, ex, ey, steps)
 
-    def dump(self, filename):
-        '''dump device window and pull to local file.'''
-        device_file = self.server.jsonrpc.dumpWindowHierarchy(True, "dump.xml")
-        if device_file is None or len(device_file) is 0:
-            return None
-        p = adb_cmd("pull", device_file, filename)
-        p.wait()
-        adb_cmd("shell", "rm", device_file)
-        return filename if p.returncode is 0 else None
+def _decode_content(body, encoding):
+    '''decompress http body of gzip or deflate content encoding.'''
+    encoding = (encoding or "identity").strip().lower()
+    if encoding == "gzip":
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        try:
+            return zlib.decompress(body)
+        except zlib.error:  # raw deflate stream without zlib header
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
 
-    def screenshot(self, filename, scale=1.0, quality=100):
-        '''take screenshot.'''
-        device_file = self.server.jsonrpc.takeScreenshot(
-            "screenshot.png", scale, quality)
-        if device_file is None or len(device_file) is 0:
-            return None
-        p = adb_cmd("pull", device_file, filename)
-        p.wait()
-        adb_cmd("shell", "rm", device_file)
-        return filename if p.returncode is 0 else None
 
-    def freeze_rotation(self, freeze=True):
-        '''freeze or unfreeze the device rotation in current status.'''
-        self.server.jsonrpc.freezeRotation(freeze)
+_transport_errors = (socket.error, httplib.HTTPException)
 
-    @property
-    def orientation(self):
-        '''
-        orienting the devie to left/right or natural.
-        left/l:       rotation=90 , displayRotation=1
-        right/r:      rotation=270, displayRotation=3
+# rpc methods which do not change the device.
+_readonly_methods = set([
+    "ping", "deviceInfo", "objInfo", "exist", "waitForExists", "waitUntilGone",
+    "waitForIdle", "waitForWindowUpdate", "dumpWindowHierarchy", "takeScreenshot",
+    "getLastTraversedText", "hasWatcherTriggered"
+])
+
+# quick reads which are safe to send again, retried or hedged.
+_idempotent_methods = set([
+    "ping", "deviceInfo", "objInfo", "exist", "dumpWindowHierarchy", "takeScreenshot",
+    "getLastTraversedText", "hasWatcherTriggered"
+])
+
+
+class ReplayDivergence(Exception):
+
+    '''the replayed script issues a call different from the recorded one.'''
+
+    def __init__(self, index, expected, actual):
+        Exception.__init__(self, "Call #%d diverged from recording, expected %s, got %s." % (index, expected, actual))
+        self.index = index
+        self.expected = expected
+        self.actual = actual
+
+
+_session_format = "uiautomator-session"
+
+
+def _rpc_key(request_body):
+    '''request without the random id, to compare calls across runs.'''
+    request = json.loads(request_body)
+    if isinstance(request, dict):
+        request.pop("id", None)
+    return request
+
+
+class _SessionRecorder(object):
+
+    '''
+    record rpc requests and responses, and pulled device files, to an append
+    only log of json lines. Pulled files are compressed, and stored once per
+    content. Pings are not recorded, since they depend on the server state.
+    '''
+
+    replaying = False
+
+    def __init__(self, filename):
+        self.__file = open(filename, "ab")
+        self.__start = time.time()
+        self.__blobs = set()
+        self.__lock = threading.Lock()
+        self.closed = False
+        self.__write([_session_format, 1, {"version": __version__, "time": self.__start}])
+
+    def __write(self, entry):
+        with self.__lock:
+            self.__file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def rpc(self, request_body, send):
+        key = _rpc_key(request_body)
+        start = time.time()
+        response_body = send()
+        if isinstance(key, dict) and key.get("method") == "ping":
+            return response_body
+        response = json.loads(response_body)
+        if isinstance(response, dict):
+            response.pop("id", None)
+        self.__write(["rpc", start - self.__start, time.time() - start, key, response])
+        return response_body
+
+    def pull(self, remote, read):
+        start = time.time()
+        data = read()
+        digest = None
+        if data is not None:
+            digest = hashlib.sha1(data).hexdigest()
+            if digest not in self.__blobs:
+                self.__blobs.add(digest)
+                self.__write(["blob", digest, base64.b64encode(zlib.compress(data))])
+        self.__write(["pull", start - self.__start, time.time() - start, remote, digest])
+        return data
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _SessionReplayer(object):
+
+    '''
+    serve rpc responses and pulled device files from the recorded log, at
+    full speed or with the original timing. ReplayDivergence is raised once
+    the script issues a call other than the recorded one.
+    '''
+
+    replaying = True
+
+    def __init__(self, filename, timing=False):
+        self.__entries = []
+        self.__blobs = {}
+        with open(filename, "rb") as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry[0] == "blob":
+                    self.__blobs[entry[1]] = entry[2]
+                elif entry[0] != _session_format:
+                    self.__entries.append(entry)
+        self.__timing = timing
+        self.__start = time.time()
+        self.__lock = threading.Lock()
+        self.position = 0
+        self.closed = False
+
+    @property
+    def remaining(self):
+        '''number of recorded calls not replayed yet.'''
+        return len(self.__entries) - self.position
+
+    def __next(self, kind, key):
+        with self.__lock:
+            if self.position >= len(self.__entries):
+                raise ReplayDivergence(self.position, None, [kind, key])
+            entry = self.__entries[self.position]
+            if entry[0] != kind or entry[3] != key:
+                raise ReplayDivergence(self.position, entry[:1] + entry[3:4], [kind, key])
+            self.position += 1
+        if self.__timing:
+            delay = self.__start + entry[1] + entry[2] - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return entry[4]
+
+    def rpc(self, request_body, send):
+        key = _rpc_key(request_body)
+        if isinstance(key, dict) and key.get("method") == "ping":
+            return json.dumps({"jsonrpc": "2.0", "id": json.loads(request_body).get("id"), "result": "pong"})
+        response = self.__next("rpc", key)
+        if isinstance(response, dict):
+            response = dict(response, id=json.loads(request_body).get("id"))
+        return json.dumps(response)
+
+    def pull(self, remote, read):
+        digest = self.__next("pull", remote)
+        return None if digest is None else zlib.decompress(base64.b64decode(self.__blobs[digest]))
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _InfoCache(object):
+
+    '''
+    cache of ui object info. Entries expire after ttl seconds, and all are
+    invalidated once any rpc call which may change the device is invoked.
+    '''
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl  # default ttl, None means disabled.
+        self.hits = 0
+        self.misses = 0
+        self.__entries = {}
+        self.__epoch = 0  # increased on invalidation
+        self.__lock = threading.Lock()
+
+    def get(self, key, ttl, load):
+        entry = self.__entries.get(key)
+        if entry is not None and entry[0] > time.time():
+            with self.__lock:
+                self.hits += 1
+            return entry[1]
+        with self.__lock:
+            self.misses += 1
+            epoch = self.__epoch
+        value = load()
+        with self.__lock:
+            if epoch == self.__epoch:  # not invalidated by other threads while loading.
+                self.__entries[key] = (time.time() + ttl, value)
+        return value
+
+    def invalidate(self):
+        with self.__lock:
+            self.__epoch += 1
+            self.__entries.clear()
+
+    @property
+    def epoch(self):
+        '''increased once any action may have changed the device.'''
+        return self.__epoch
+
+
+class _JsonRpcMethod(object):
+
+    def __init__(self, server, method):
+        self.__server = server
+        self.__method = method
+
+    def __call__(self, *args, **kwargs):
+        return self.__server.call(self.__method, *args, **kwargs)
+
+
+class _JsonRpcProxy(object):
+
+    '''jsonrpclib.Server like proxy, which dispatches rpc calls via _AutomatorServer.'''
+
+    def __init__(self, server):
+        self.__server = server
+
+    def __getattr__(self, method):
+        return _JsonRpcMethod(self.__server, method)
+
+
+class _Future(object):
+
+    '''result of a rpc call queued in batch, available after the batch is sent.'''
+
+    def __init__(self, method):
+        self.method = method
+        self.__done = False
+        self.__result = None
+        self.__exception = None
+
+    def _set(self, result, exception):
+        self.__result, self.__exception = result, exception
+        self.__done = True
+
+    def done(self):
+        return self.__done
+
+    def exception(self):
+        if not self.__done:
+            raise RuntimeError("Batch of %s has not been sent." % self.method)
+        return self.__exception
+
+    def result(self):
+        if self.exception() is not None:
+            raise self.__exception
+        return self.__result
+
+
+class _Batch(object):
+
+    '''queue rpc calls and send them as one json-rpc batch request.'''
+
+    def __init__(self, server):
+        self.__server = server
+        self.__pending = []
+        self.futures = []
+
+    def add(self, method, args, kwargs):
+        future = _Future(method)
+        self.__pending.append(((method, args, kwargs), future))
+        self.futures.append(future)
+        return future
+
+    def __enter__(self):
+        self.__server._begin_batch(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__server._end_batch()
+        if exc_type is None:
+            self.send()
+
+    def send(self):
+        '''send the queued calls and set results of their futures.'''
+        pending, self.__pending = self.__pending, []
+        if pending:
+            results = self.__server._send_batch([call for call, future in pending])
+            for (call, future), (result, exception) in zip(pending, results):
+                future._set(result, exception)
+
+
+_jar_files = {
+    "bundle.jar": 'https://github.com/xiaocong/android-uiautomator-jsonrpcserver/blob/release/dist/bundle.jar?raw=true',
+    "uiautomator-stub.jar": "https://github.com/xiaocong/android-uiautomator-jsonrpcserver/blob/release/dist/uiautomator-stub.jar?raw=true"
+}
+
+
+_jar_digests = {}  # jar name: sha1 pinned for its url, downloads of other content are refused.
+
+_jar_device_path = "/data/local/tmp/"
+_jar_lock = threading.Lock()
+
+
+def _sha1(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _write_atomically(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+def _download_jars():
+    '''
+    download jar files of rpc server if not cached, and return dict of jar
+    name to local path. A jar is cached as <sha1>.jar and referred by
+    <name>.sha1 in a directory private to the user, so it's verified by
+    content before used, and downloaded again if missing or corrupted.
+    A jar whose sha1 is pinned in _jar_digests must match it.
+    '''
+    lib_path = os.path.join(tempfile.gettempdir(), "uiautomator-libs-%d" % os.getuid())
+    jars = {}
+    with _jar_lock:
+        if not os.path.exists(lib_path):
+            os.mkdir(lib_path, 0700)
+        for jar, url in _jar_files.items():
+            pinned = _jar_digests.get(jar)
+            ref = os.path.join(lib_path, jar + ".sha1")
+            if os.path.exists(ref):
+                with open(ref) as f:
+                    digest = f.read().strip()
+                jarfile = os.path.join(lib_path, digest + ".jar")
+                if pinned in (None, digest) and os.path.exists(jarfile) and _sha1(jarfile) == digest:
+                    jars[jar] = jarfile
+                    continue
+            data = urllib2.urlopen(url, timeout=_remaining(60)).read()
+            digest = hashlib.sha1(data).hexdigest()
+            if pinned not in (None, digest):
+                raise EnvironmentError("%s downloaded from %s has sha1 %s, not %s." % (jar, url, digest, pinned))
+            jarfile = os.path.join(lib_path, digest + ".jar")
+            _write_atomically(jarfile, data)
+            _write_atomically(ref, digest)
+            jars[jar] = jarfile
+    return jars
+
+
+def _push_if_changed(local, remote, serial=None):
+    '''push local file unless the remote one has the same size and mtime, return True if pushed.'''
+    try:
+        with AdbClient(serial).sync() as sync:
+            st = os.stat(local)
+            mode, size, mtime = sync.stat(remote)
+            if mode and size == st.st_size and mtime == int(st.st_mtime):
+                return False
+            sync.push(local, remote)
+            return True
+    except socket.error:
+        return _wait(adb_cmd("push", local, remote, serial=serial)) is 0
+
+
+def _push_jars(jars, serial=None):
+    '''push jars to device in parallel, skipping unchanged ones, and return names of pushed jars.'''
+    results = {}
+    timeout = _remaining()  # the deadline of this thread is not seen by push threads.
+
+    def push(name):
+        with deadline(timeout):
+            results[name] = _call_catching(_push_if_changed, jars[name], _jar_device_path + name, serial)
+
+    threads = [threading.Thread(target=push, args=(name,)) for name in jars]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    until = None if timeout is None else time.time() + timeout
+    for t in threads:
+        t.join(None if until is None else max(until - time.time(), 0))
+        if t.is_alive():
+            raise DeadlineExceeded("jars are not pushed in %.3f seconds." % timeout)
+    for result in results.values():
+        if isinstance(result, Exception):
+            raise result
+    return [name for name in jars if results[name]]
+
+
+def _runtest_args(jars):
+    return ["shell", "uiautomator", "runtest"] + list(jars) + ["-c", "com.github.uiautomatorstub.Stub"]
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class _ServerLease(object):
+
+    '''
+    lease of rpc server on device shared by local processes. Each holder
+    owns a file named <pid>.<id> under the lease directory of the device,
+    leases of dead processes are expired. Lease directories are per user,
+    as processes of other users can not share the same rpc server.
+    '''
+
+    def __init__(self, serial, device_port):
+        self.path = os.path.join(tempfile.gettempdir(),
+                                 "uiautomator-leases-%d" % os.getuid(),
+                                 "%s-%d" % (serial or "default", device_port))
+        self.__name = "%d.%d" % (os.getpid(), id(self))
+
+    def acquire(self):
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        open(os.path.join(self.path, self.__name), "w").close()
+
+    def release(self):
+        '''release the lease, and return number of remaining live holders.'''
+        try:
+            os.remove(os.path.join(self.path, self.__name))
+        except OSError:
+            pass
+        return len(self.holders())
+
+    @property
+    def held(self):
+        return os.path.exists(os.path.join(self.path, self.__name))
+
+    def holders(self):
+        '''return names of live holders, and remove the expired ones.'''
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return []
+        holders = []
+        for name in names:
+            try:
+                pid, _ = map(int, name.split("."))
+            except ValueError:
+                continue  # not a lease file
+            if _pid_alive(pid):
+                holders.append(name)
+            else:
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+        return holders
+
+
+class _Stopwatch(object):
+
+    '''record elapsed seconds of each phase.'''
+
+    def __init__(self):
+        self.laps = {}
+        self.__start = self.__last = time.time()
+
+    def lap(self, phase):
+        now = time.time()
+        self.laps[phase] = now - self.__last
+        self.__last = now
+
+    def stop(self):
+        self.laps["total"] = time.time() - self.__start
+        return self.laps
+
+
+class _AutomatorServer(object):
+
+    """start and quit rpc server on device.
+    """
+    STOPPED, STARTING, ALIVE, DEAD = "stopped", "starting", "alive", "dead"
+
+    def __init__(self, serial=None, local_port=None):
+        '''
+        serial: serial number of the device, $ANDROID_SERIAL by default.
+        local_port: local port forwarded to device, 9008 for the default
+                    device, or a free port allocated for the given serial.
+        '''
+        self.__automator_process = None
+        self.__serial = serial or os.environ.get("ANDROID_SERIAL")
+        if local_port is None:
+            local_port = 9008 if serial is None else next_local_port()
+        self.__local_port = local_port
+        self.__device_port = 9008
+        self.__transport = _JsonRpcTransport()
+        self.__rpc = None
+        self.__state = self.STOPPED
+        self.__jsonrpc = _JsonRpcProxy(self)
+        self.__local = threading.local()  # batch of the thread
+        self.__lock = threading.RLock()  # guards start, attach and stop
+        self.__generation = 0  # increased once the server is (re)started or attached
+        self.__batch_supported = None
+        self.inline_dump = None  # whether the xml is returned by dumpWindowHierarchy, None if not known yet.
+        self.info_cache = _InfoCache()
+        self.start_timing = {}
+        self.__lease = _ServerLease(self.__serial, self.__device_port)
+        self.hooks = []  # hooks of rpc calls of this server, see add_hook.
+        self.timeout = None  # seconds of each rpc call, None to wait until the deadline of the scope if any.
+        self.retries = 2  # times to retry idempotent reads which time out or lose the connection.
+        self.hedge_after = None  # seconds before an idempotent read is sent again on another connection.
+        self.max_hedges = 8  # hedges in flight at most, more slow reads are not hedged.
+        self.counters = collections.Counter()  # timeouts, retries, hedges, hedge_wins and hedges_skipped.
+        self.__counters_lock = threading.Lock()
+        self.__hedge_pool = None
+        self.__hedge_slots = None
+
+    def __get__(self, instance, owner):
+        return self
+
+    @property
+    def jsonrpc(self):
+        return self.__jsonrpc
+
+    def __server_proxy(self):
+        if self.__rpc is None:
+            self.__rpc = jsonrpclib.Server(self.rpc_uri, transport=self.__transport)
+        return self.__rpc
+
+    @property
+    def serial(self):
+        return self.__serial
+
+    @property
+    def state(self):
+        '''server state, one of "stopped", "starting", "alive" or "dead".'''
+        return self.__state
+
+    def call(self, method, *args, **kwargs):
+        '''
+        invoke the rpc method. The server is started on the first call if it
+        is not running yet, and restarted once if the connection is dead.
+        In batch mode the call is queued and a _Future is returned.
+        '''
+        if method not in _readonly_methods:
+            self.info_cache.invalidate()
+        batch = getattr(self.__local, "batch", None)
+        if batch is not None:
+            return batch.add(method, args, kwargs)
+        return self.__call(lambda rpc: getattr(rpc, method)(*args, **kwargs), method)
+
+    def __call(self, func, name, kind="rpc"):
+        '''
+        invoke func within the timeout and the deadline of the scope. The
+        server is restarted once if the connection is dead, and idempotent
+        reads are retried at most retries times if they time out. Other calls
+        are sent again only if the request was not written to the server.
+        '''
+        generation = self.__ensure_alive()
+        idempotent = name in _idempotent_methods
+        retries = self.retries if idempotent else 0
+        restarted = False
+        while True:
+            try:
+                return self.__attempt(func, name, kind, idempotent)
+            except DeadlineExceeded:
+                self.__count("timeouts")
+                if retries <= 0:
+                    raise
+            except _transport_errors:
+                # an action written to the server may have been done, so it's not sent again.
+                resend = idempotent or not self.__transport.written
+                if not restarted:
+                    restarted = True
+                    with self.__lock:
+                        # not restarted by other threads yet, and not only the connection is lost.
+                        if generation == self.__generation and not self.__can_ping():
+                            self.start()
+                        generation = self.__generation
+                    if resend:
+                        continue
+                if not resend or retries <= 0:
+                    raise
+            _remaining()  # no retry once the deadline of the scope has passed.
+            retries -= 1
+            self.__count("retries")
+
+    def __count(self, counter):
+        with self.__counters_lock:
+            self.counters[counter] += 1
+
+    def __attempt(self, func, name, kind, idempotent):
+        timeout = _remaining(self.timeout)
+        hedge_after = self.hedge_after
+        if idempotent and hedge_after is not None and (timeout is None or hedge_after < timeout) \
+                and self.session is None and not self.batching:
+            return self.__hedged(func, name, kind, timeout, hedge_after)
+        self.__transport.timeout = timeout
+        self.__transport.idempotent = idempotent
+        return self.__invoke(func, name, kind)
+
+    def __hedged(self, func, name, kind, timeout, hedge_after):
+        '''
+        invoke func in this thread, and once again on a pool thread if there
+        is no response in hedge_after seconds. The first success wins and
+        aborts the other attempt. Slow reads are not hedged if max_hedges
+        hedges are in flight already, so they never queue behind stalled ones.
+        '''
+        until = None if timeout is None else time.time() + timeout
+        results = Queue.Queue()
+        hedge = _Attempt()
+
+        def run_hedge():
+            try:
+                left = None if until is None else until - time.time()
+                if left is not None and left <= 0:
+                    raise DeadlineExceeded("Deadline exceeded.")
+                self.__transport.timeout = left
+                self.__transport.idempotent = True
+                self.__transport.attempt = hedge
+                try:
+                    results.put((self.__invoke(func, name, kind), None))
+                finally:
+                    self.__transport.attempt = None
+                primary.abort()
+            except Exception as e:
+                results.put((None, e))
+            finally:
+                self.__hedge_slots.release()
+
+        def send_hedge():
+            with self.__lock:
+                if self.__hedge_pool is None:
+                    self.__hedge_pool = ThreadPool(self.max_hedges)
+                    self.__hedge_slots = threading.BoundedSemaphore(self.max_hedges)
+            if self.__hedge_slots.acquire(False):
+                self.__count("hedges")
+                self.__hedge_pool.apply_async(run_hedge)
+            else:
+                self.__count("hedges_skipped")
+
+        primary = _Attempt(hedge_after, send_hedge)
+        self.__transport.timeout = timeout
+        self.__transport.idempotent = True
+        self.__transport.attempt = primary
+        try:
+            result = self.__invoke(func, name, kind)
+        except _Aborted:
+            result, error = results.get()  # the hedge has won, and put its result before aborting.
+            if error is not None:
+                raise error
+            self.__count("hedge_wins")
+            return result
+        except Exception:
+            hedge.abort()  # bounded by the same timeout, so it's not waited for.
+            raise
+        finally:
+            self.__transport.attempt = None
+        hedge.abort()
+        return result
+
+    def __ensure_alive(self):
+        '''start the server unless it's alive, and return its generation.'''
+        if self.__state != self.ALIVE:
+            with self.__lock:
+                if self.__state == self.STOPPED and self.attach():
+                    pass  # the server is already running on device.
+                elif self.__state != self.ALIVE:
+                    self.start()
+        return self.__generation
+
+    def __invoke(self, func, name, kind):
+        try:
+            result = self.__observed(func, name, kind)
+        except _transport_errors:
+            self.__state = self.DEAD
+            raise
+        self.__state = self.ALIVE
+        return result
+
+    def __observed(self, func, name, kind):
+        '''call func with the rpc proxy, and report it to hooks if any.'''
+        hooks = self.hooks + _hooks if self.hooks else _hooks
+        if not hooks:
+            return func(self.__server_proxy())
+        event = CallEvent(kind, name, self.__serial)
+        connects = self.__transport.connects
+        try:
+            return func(self.__server_proxy())
+        except Exception as e:
+            event.error = e
+            raise
+        finally:
+            event.sent, event.received = self.__transport.sent, self.__transport.received
+            event.connected = self.__transport.connects > connects
+            _emit(hooks, event)
+
+    def batch(self):
+        '''return a context manager, rpc calls in which are sent as one batch request.'''
+        return _Batch(self)
+
+    @property
+    def session(self):
+        '''recorder or replayer of the session, None if not recording or replaying.'''
+        session = self.__transport.session
+        if session is not None and session.closed:
+            session = self.__transport.session = None
+        return session
+
+    def __open_session(self, session):
+        if self.session is not None:
+            session.close()
+            raise RuntimeError("Session is already being recorded or replayed.")
+        self.__transport.session = session
+        return session
+
+    def record(self, filename):
+        '''record rpc calls and pulled files to the log file, until the returned recorder is closed.'''
+        return self.__open_session(_SessionRecorder(filename))
+
+    def replay(self, filename, timing=False):
+        '''
+        replay the recorded log file instead of calling the device, until the
+        returned replayer is closed. With timing, responses are delayed as
+        recorded, otherwise served at full speed.
+        '''
+        return self.__open_session(_SessionReplayer(filename, timing))
+
+    @property
+    def batching(self):
+        '''whether calls of this thread are queued in a batch.'''
+        return getattr(self.__local, "batch", None) is not None
+
+    def _begin_batch(self, batch):
+        if self.batching:
+            raise RuntimeError("Batch can not be nested.")
+        self.__local.batch = batch
+
+    def _end_batch(self):
+        self.__local.batch = None
+
+    def _send_batch(self, calls):
+        '''
+        send (method, args, kwargs) calls as one json-rpc batch request, and
+        return a list of (result, exception) in the same order. Fall back to
+        sequential calls if the server does not support batch request.
+        '''
+        if self.__batch_supported is not False:
+            body = "[%s]" % ",".join(jsonrpclib.dumps(kwargs or args, method, rpcid=i, version=2.0)
+                                     for i, (method, args, kwargs) in enumerate(calls, 1))
+            try:
+                responses = self.__call(lambda rpc: rpc._run_request(body), "batch", "batch")
+            except xmlrpclib.ProtocolError:
+                responses = None
+            self.__batch_supported = isinstance(responses, list)
+            if self.__batch_supported:
+                responses = dict((r.get("id"), r) for r in responses)
+                results = []
+                for i in range(1, len(calls) + 1):
+                    try:
+                        jsonrpclib.jsonrpc.check_for_errors(responses.get(i))
+                        results.append((responses[i]["result"], None))
+                    except Exception as e:
+                        results.append((None, e))
+                return results
+        results = []
+        for method, args, kwargs in calls:
+            try:
+                results.append((self.call(method, *args, **kwargs), None))
+            except Exception as e:
+                results.append((None, e))
+        return results
+
+    def start(self, local_port=None, device_port=None, timeout=30):
+        '''
+        start rpc server on device, and raise if it's not ready in timeout
+        seconds, which bound all phases from pushing jars to waiting until
+        it's ready. Elapsed seconds of each phase are kept in start_timing.
+        '''
+        with self.__lock:
+            self.__state = self.STARTING
+            if local_port is not None:
+                self.__local_port = local_port
+            if device_port is not None and device_port != self.__device_port:
+                self.__lease.release()
+                self.__device_port = device_port
+                self.__lease = _ServerLease(self.__serial, device_port)
+            self.__rpc = None
+            self.info_cache.invalidate()
+            timeout = _remaining(timeout)
+            stopwatch = _Stopwatch()
+            hooks = self.hooks + _hooks if self.hooks else _hooks
+            event = CallEvent("start", "start", self.__serial) if hooks else None
+            try:
+                with deadline(timeout):
+                    _check_attached(adb_devices(), self.__serial)
+                    stopwatch.lap("devices")
+                    jars = _download_jars()
+                    stopwatch.lap("download")
+                    _push_jars(jars, self.__serial)
+                    stopwatch.lap("push")
+                    self.__automator_process = adb_cmd(*_runtest_args(jars), serial=self.__serial)
+                    stopwatch.lap("launch")
+                    adb_forward(self.__local_port, self.__device_port, serial=self.__serial)
+                    stopwatch.lap("forward")
+                    self.__transport.close()
+                    self.__wait_ready(_remaining())
+                    stopwatch.lap("ready")
+            except BaseException as e:
+                self.__state = self.STOPPED
+                if event is not None:
+                    event.error = e
+                raise
+            finally:
+                self.start_timing = stopwatch.stop()
+                if event is not None:
+                    _emit(hooks, event)
+            self.__lease.acquire()
+            self.__generation += 1
+            self.__state = self.ALIVE
+
+    def __wait_ready(self, timeout):
+        '''ping the server with exponential backoff until it's ready.'''
+        deadline = time.time() + timeout
+        interval = 0.05
+        while not self.__can_ping(max(deadline - time.time(), 0.001)):
+            if self.__automator_process.poll() is not None:
+                raise EnvironmentError("RPC server exited with code %d." % self.__automator_process.returncode)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise EnvironmentError("RPC server is not ready in %s seconds." % timeout)
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, 0.5)
+
+    def __can_ping(self, timeout=3):
+        try:
+            self.__transport.timeout = _remaining(timeout)
+            self.__transport.idempotent = True
+            # not use self.jsonrpc here to avoid recursive invoke
+            return self.__observed(lambda rpc: rpc.ping(), "ping", "ping") == "pong"
+        except:
+            return False
+
+    @property
+    def alive(self):
+        '''Check if the rpc server is alive.'''
+        if self.__can_ping():
+            self.__state = self.ALIVE
+            return True
+        elif self.__state == self.ALIVE:
+            self.__state = self.DEAD
+        return False
+
+    def attach(self):
+        '''
+        attach to the rpc server already running on device, through the local
+        port or any existing forward to the device port. Return True and take
+        a lease of the server if attached, so it's not stopped by others.
+        '''
+        with self.__lock:
+            if self.__can_ping():
+                self.__attached()
+                return True
+            try:
+                forwards = adb_forwards(self.__serial)
+            except EnvironmentError:
+                return False
+            local_port = self.__local_port
+            for port in set(local for local, remote in forwards if remote == self.__device_port):
+                self.__use_port(port)
+                if self.__can_ping():
+                    self.__attached()
+                    return True
+            self.__use_port(local_port)
+            return False
+
+    def __use_port(self, port):
+        self.__local_port = port
+        self.__rpc = None
+        self.__transport.close()
+
+    def __attached(self):
+        self.__lease.acquire()
+        self.__generation += 1
+        self.__state = self.ALIVE
+
+    @property
+    def leased(self):
+        '''whether this server holds a lease of the rpc server on device.'''
+        return self.__lease.held
+
+    def stop(self, force=False):
+        '''
+        Stop the rpc server, unless it's still leased by other servers in
+        this or other processes and force is False. Return True if stopped.
+        '''
+        with self.__lock:
+            self.__state = self.STOPPED
+            if self.__lease.release() and not force:
+                self.__transport.close()
+                return False
+            if self.__automator_process is not None and self.__automator_process.poll() is None:
+                try:
+                    urllib2.urlopen(self.stop_uri, timeout=_remaining(5))
+                    _wait(self.__automator_process, 5)
+                except:
+                    self.__automator_process.kill()
+                finally:
+                    self.__automator_process = None
+            self.__transport.close()
+            self.kill_stale()
+            return True
+
+    def kill_stale(self):
+        '''kill all uiautomator processes on device in one shell command, return their pids.'''
+        out = adb_shell("ps", "-C", "uiautomator", serial=self.__serial).strip().splitlines()
+        if not out:
+            return []
+        index = out[0].split().index("PID")
+        pids = [line.split()[index] for line in out[1:] if "uiautomator" in line]
+        if pids:
+            adb_shell("kill", "-9", *pids, serial=self.__serial)
+        return pids
+
+    @property
+    def stop_uri(self):
+        return "http://localhost:%d/stop" % self.__local_port
+
+    @property
+    def rpc_uri(self):
+        return "http://localhost:%d/jsonrpc/device" % self.__local_port
+
+
+class _AutomatorDevice(object):
+
+    '''uiautomator wrapper of android device'''
+    full_selector = False  # send selectors with all fields, for servers not accepting compact ones.
+    _last_snapshot = None  # (epoch of info cache, time, snapshot) of the last snapshot
+
+    _orientation = (  # device orientation
+        (0, "natural", "n", 0),
+        (1, "left", "l", 90),
+        (2, "upsidedown", "u", 180),
+        (3, "right", "r", 270)
+    )
+
+    def __init__(self, serial=None, local_port=None):
+        self.server = _AutomatorServer(serial, local_port)
+
+    @property
+    def serial(self):
+        return self.server.serial
+
+    def __call__(self, **kwargs):
+        return _AutomatorDeviceObject(self, **kwargs)
+
+    def record(self, filename):
+        '''
+        record rpc calls, dumps and screenshots of the device to the log file.
+        Usage:
+        with d.record("session.log"):
+            d(text="Settings").click()
+        '''
+        return self.server.record(filename)
+
+    def replay(self, filename, timing=False):
+        '''
+        replay the recorded log file without device, ReplayDivergence is
+        raised if calls differ from the recorded ones.
+        Usage:
+        with d.replay("session.log") as replayer:
+            d(text="Settings").click()
+        replayer.remaining  # recorded calls not replayed
+        '''
+        return self.server.replay(filename, timing)
+
+    def batch(self):
+        '''
+        queue rpc calls and send them in one batch request on exit.
+        Usage:
+        with d.batch():
+            d.press.back()
+            found = d(text="OK").exist()
+        found.result()
+        '''
+        return self.server.batch()
+
+    @property
+    def info_cache(self):
+        '''cache of ui object info, with hits and misses counters.'''
+        return self.server.info_cache
+
+    def cache_info(self, ttl=1.0):
+        '''
+        cache info of all ui objects for ttl seconds, None to disable. The
+        cache is invalidated by any action which may change the device.
+        '''
+        self.server.info_cache.ttl = ttl
+
+    def ping(self):
+        '''ping the device, by default it returns "pong".'''
+        return self.server.jsonrpc.ping()
+
+    @property
+    def info(self):
+        '''Get the device info.'''
+        return self.server.jsonrpc.deviceInfo()
+
+    def click(self, x, y):
+        '''click at arbitrary coordinates.'''
+        return self.server.jsonrpc.click(x, y)
+
+    def swipe(self, sx, sy, ex, ey, steps=100):
+        return self.server.jsonrpc.swipe(sx, sy, ex, ey, steps)
+
+    def drag(self, sx, sy, ex, ey, steps=100):
+        '''Swipe from one point to another point.'''
+        return self.server.jsonrpc.drag(sx, sy, ex, ey, steps)
+
+    def __pull(self, device_file, filename):
+        '''pull device file to local file, or return its content if filename is None.'''
+        if device_file is None or len(device_file) is 0:
+            return None
+        session = self.server.session
+        if session is not None:
+            data = session.pull(device_file, lambda: self.__read(device_file))
+            if filename is None or data is None:
+                return data
+            with open(filename, "wb") as f:
+                f.write(data)
+            return filename
+        if filename is None:
+            return self.__read(device_file)
+        result = filename if adb_pull(device_file, filename, serial=self.serial) else None
+        adb_shell("rm", device_file, serial=self.serial)
+        return result
+
+    def __read(self, device_file):
+        data = adb_read(device_file, serial=self.serial)
+        adb_shell("rm", device_file, serial=self.serial)
+        return data
+
+    def dump(self, filename=None, format="bytes", inline=True):
+        '''
+        dump device window and save to local file, or return the xml if filename
+        is None, in format "bytes" (utf-8), "text" (unicode) or "tree" (root
+        element). The xml is returned by the rpc call itself if the server
+        supports it and inline is True, otherwise it's written to a device file
+        and pulled.
+        '''
+        if format not in ("bytes", "text", "tree"):
+            raise ValueError("format should be bytes, text or tree.")
+        if self.server.batching:
+            raise RuntimeError("Window hierarchy can not be read in a batch.")
+        xml = device_file = None
+        if inline and self.server.inline_dump is not False:
+            try:
+                result = self.server.jsonrpc.dumpWindowHierarchy(True, None)
+            except jsonrpclib.ProtocolError:
+                result = None
+            self.server.inline_dump = isinstance(result, basestring) and result.lstrip().startswith("<")
+            if self.server.inline_dump:
+                xml = result
+            elif isinstance(result, basestring) and result:
+                device_file = result  # an old server wrote it to a device file anyway.
+        if xml is None:
+            if device_file is None:
+                device_file = self.server.jsonrpc.dumpWindowHierarchy(True, "dump.xml")
+            if filename is not None:
+                return self.__pull(device_file, filename)
+            xml = self.__pull(device_file, None)
+            if xml is None:
+                return None
+        if filename is not None:
+            with open(filename, "wb") as f:
+                f.write(_xml_bytes(xml))
+            return filename
+        if format == "text":
+            return xml if isinstance(xml, unicode) else xml.decode("utf-8")
+        elif format == "tree":
+            return ElementTree.fromstring(_xml_bytes(xml))
+        return _xml_bytes(xml)
+
+    def snapshot(self):
+        '''dump device window once, on which selectors can be evaluated locally.'''
+        epoch = self.server.info_cache.epoch
+        xml = self.dump()
+        if xml is None:
+            raise EnvironmentError("Failed to dump window hierarchy.")
+        snapshot = _Snapshot(xml)
+        self._last_snapshot = (epoch, time.time(), snapshot)  # reused by watchers until any action
+        return snapshot
+
+    def screenshot(self, filename=None, scale=1.0, quality=100):
+        '''take screenshot, save to local file, or return the png data if filename is None.'''
+        if self.server.batching:
+            raise RuntimeError("Screenshot can not be pulled in a batch.")
+        device_file = self.server.jsonrpc.takeScreenshot(
+            "screenshot.png", scale, quality)
+        return self.__pull(device_file, filename)
+
+    def capture_stream(self, fps=10, scale=1.0, quality=100):
+        '''
+        capture screenshots continuously, at most fps frames per second.
+        Usage:
+        stream = d.capture_stream(fps=5, scale=0.5)
+        for png in itertools.islice(stream, 100):
+            process(png)
+        stream.close()
+        stream.fps, stream.latency  # achieved fps, and mean latency of frame
+        '''
+        return _CaptureStream(self, fps, scale, quality)
+
+    def freeze_rotation(self, freeze=True):
+        '''freeze or unfreeze the device rotation in current status.'''
+        return self.server.jsonrpc.freezeRotation(freeze)
+
+    @property
+    def orientation(self):
+        '''
+        orienting the devie to left/right or natural.
+        left/l:       rotation=90 , displayRotation=1
+        right/r:      rotation=270, displayRotation=3
         natural/n:    rotation=0  , displayRotation=0
         upsidedown/u: rotation=180, displayRotation=2
         '''
+        if self.server.batching:
+            raise RuntimeError("Orientation can not be read in a batch, use info instead.")
         return self._orientation[self.info["displayRotation"]][1]
 
     @orientation.setter
@@ -353,33 +2527,41 @@ class _AutomatorDevice(object):
 
     def clear_traversed_text(self):
         '''clear the last traversed text.'''
-        self.server.jsonrpc.clearLastTraversedText()
+        return self.server.jsonrpc.clearLastTraversedText()
 
-    @property
-    def open(self):
+    @_action_property(target=["notification", "quick_settings"])
+    def open(self, target):
         '''
         Open notification or quick settings.
         Usage:
         d.open.notification()
         d.open.quick_settings()
         '''
-        obj = self
-
-        class Target(object):
-
-            def notification(self):
-                return obj.server.jsonrpc.openNotification()
-
-            def quick_settings(self):
-                return obj.server.jsonrpc.openQuickSettings()
-        return Target()
+        if target == "notification":
+            return self.server.jsonrpc.openNotification()
+        return self.server.jsonrpc.openQuickSettings()
 
     def watcher_triggered(self, name):
         '''check if the registered watcher was triggered.'''
         return self.server.jsonrpc.hasWatcherTriggered(name)
 
     @property
-    def press(self):
+    def watchers(self):
+        '''
+        client side watchers, checked on hierarchy snapshots by a background thread.
+        Usage:
+        d.watchers.register("ANR", when=d(textContains="isn't responding"), do=d(text="Close"))
+        d.watchers.register("rating", when=d(text="Rate this app"), do="back")
+        with d.watchers.paused():
+            d(text="Pay").click()  # no watcher acts in between
+        d.watchers.counts  # {"ANR": 1, "rating": 0}
+        '''
+        if "_watchers" not in self.__dict__:
+            self.__dict__.setdefault("_watchers", _Watchers(self))  # only one of racing threads wins.
+        return self.__dict__["_watchers"]
+
+    @_action_property(key=["home", "back", "left", "right", "up", "down", "center", "menu", "search", "enter", "delete", "del", "recent", "voulmn_up", "volumn_down", "volumn_mute", "camera", "power"])
+    def press(self, key, meta=None):
         '''
         press key via name or key code. Supported key name includes:
         home, back, left, right, up, down, center, menu, search, enter,
@@ -390,55 +2572,95 @@ class _AutomatorDevice(object):
         d.press.menu()  # press home key
         d.press(89)     # press keycode
         '''
-        obj = self
-        @param_to_property(key=["home", "back", "left", "right", "up", "down", "center", "menu", "search", "enter", "delete", "del", "recent", "voulmn_up", "volumn_down", "volumn_mute", "camera", "power"])
-        def _press(key, meta=None):
-            if isinstance(key, int):
-                return obj.server.jsonrpc.pressKeyCode(key, meta) if meta else self.server.jsonrpc.pressKeyCode(key)
-            else:
-                return obj.server.jsonrpc.pressKey(str(key))
-        return _press
+        if isinstance(key, int):
+            return self.server.jsonrpc.pressKeyCode(key, meta) if meta else self.server.jsonrpc.pressKeyCode(key)
+        else:
+            return self.server.jsonrpc.pressKey(str(key))
 
     def wakeup(self):
         '''turn on screen in case of screen off.'''
-        self.server.jsonrpc.wakeUp()
+        return self.server.jsonrpc.wakeUp()
 
     def sleep(self):
         '''turn off screen in case of screen on.'''
-        self.server.jsonrpc.sleep()
+        return self.server.jsonrpc.sleep()
 
-    @property
-    def screen(self):
+    @_action_property(action=["on", "off"])
+    def screen(self, action):
         '''
         Turn on/off screen.
         Usage:
         d.screen.on()
         d.screen.off()
         '''
-        obj = self
-
-        @param_to_property(action=["on", "off"])
-        def _screen(action):
-            return obj.wakeup() if action is "on" else obj.sleep()
-        return _screen
+        return self.wakeup() if action == "on" else self.sleep()
 
-    @property
-    def wait(self):
+    @_action_property(action=["idle", "update", "any", "all"])
+    def wait(self, *selectors, **kwargs):
         '''
-        Waits for the current application to idle or window update event occurs.
+        Waits for the current application to idle or window update event occurs,
+        or for any or all of the selectors to match in timeout milliseconds.
         Usage:
         d.wait.idle(timeout=1000)
         d.wait.update(timeout=1000, package_name="com.android.settings")
+        d.wait.any(d(text="OK"), d(text="Error"), timeout=10000)  # the matched selector, None if timeout
+        d.wait.all(d(text="OK"), d(text="Cancel"), timeout=10000, by="snapshot")  # True if all match
+        d.wait("update", 1000, "com.android.settings")  # action, timeout and package_name
         '''
-        obj = self
+        selectors = list(selectors)
+        if "action" not in kwargs and selectors and isinstance(selectors[0], basestring):
+            kwargs["action"] = selectors.pop(0)
+        action = kwargs.pop("action", None)
+        if action in ["idle", "update"]:
+            for name in ["timeout", "package_name"]:
+                if selectors and name not in kwargs:
+                    kwargs[name] = selectors.pop(0)
+            if selectors:
+                raise TypeError("wait.%s() takes at most 2 positional arguments, timeout and package_name." % action)
+        elif action not in ["any", "all"]:
+            raise TypeError("wait() takes an action, idle, update, any or all, got %r." % (action,))
+        timeout = kwargs.get("timeout", 1000)
+        if action == "idle":
+            return self.server.jsonrpc.waitForIdle(timeout)
+        elif action == "update":
+            return self.server.jsonrpc.waitForWindowUpdate(kwargs.get("package_name"), timeout)
+        else:
+            return self.__wait_selectors(selectors, timeout, action == "all", kwargs.get("by", "batch"))
 
-        @param_to_property(action=["idle", "update"])
-        def _wait(action, timeout=1000, package_name=None):
-            if action is "idle":
-                return obj.server.jsonrpc.waitForIdle(timeout)
-            elif action is "update":
-                return obj.server.jsonrpc.waitForWindowUpdate(package_name, timeout)
-        return _wait
+    def __wait_selectors(self, selectors, timeout, match_all, by):
+        '''
+        poll until any or all selectors match. Each poll evaluates all selectors
+        in one batch request, or on one hierarchy snapshot if by is "snapshot".
+        The poll interval backs off while nothing changes, and is reset once
+        the hierarchy or the matches change.
+        '''
+        if by not in ("batch", "snapshot"):
+            raise ValueError("by should be batch or snapshot.")
+        built = [_build_selector(selector) for selector in selectors]
+        deadline = time.time() + timeout / 1000.0
+        interval = 0.05
+        previous = found = None
+        while True:
+            last_found = found
+            if by == "snapshot":
+                snapshot = self.snapshot()
+                found = [snapshot.exist(selector) for selector in built]
+                changed = previous is None or not snapshot.unchanged(previous)
+                previous = snapshot
+            else:
+                with self.server.batch():
+                    futures = [self.server.jsonrpc.exist(selector) for selector in built]
+                found = [future.result() for future in futures]
+                changed = found != last_found
+            if match_all and all(found):
+                return True
+            elif not match_all and any(found):
+                return selectors[found.index(True)]
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False if match_all else None
+            interval = 0.05 if changed else min(interval * 2, 0.5)
+            time.sleep(min(interval, remaining))
 
 
 class _AutomatorDeviceObject(object):
@@ -448,14 +2670,17 @@ class _AutomatorDeviceObject(object):
 
     __alias = {'description': "contentDescription", "class": "className"}
 
-    def __init__(self, jsonrpc, **kwargs):
-        self.jsonrpc = jsonrpc
+    def __init__(self, device, **kwargs):
+        self.device = device
+        self.jsonrpc = device.server.jsonrpc
         self.__selector = SelectorBuilder(**kwargs)
         self.__actions = []
+        self.__cache_ttl = None
+        self.__preloaded = None  # (epoch of info cache, info) fetched by all()
 
     @property
     def selector(self):
-        return self.__selector.build()
+        return self.__selector.build(self.device.full_selector)
 
     def child_selector(self, **kwargs):
         '''set chileSelector.'''
@@ -476,6 +2701,8 @@ class _AutomatorDeviceObject(object):
         try:
             return super(_AutomatorDeviceObject, self).__getattribute__(attr)
         except AttributeError:
+            if self.device.server.batching:
+                raise RuntimeError("Field %s of info can not be read in a batch, use info instead." % attr)
             info = self.info
             if attr in info:
                 return info[attr]
@@ -486,22 +2713,96 @@ class _AutomatorDeviceObject(object):
 
     @property
     def info(self):
-        '''ui object info.'''
-        return self.jsonrpc.objInfo(self.selector)
+        '''ui object info, which may be cached, see cache_info.'''
+        cache = self.device.server.info_cache
+        preloaded = self.__preloaded
+        if preloaded is not None and preloaded[0] == cache.epoch and not self.device.server.batching:
+            return preloaded[1]
+        ttl = self.__cache_ttl if self.__cache_ttl is not None else cache.ttl
+        if not ttl or self.device.server.batching:
+            return self.jsonrpc.objInfo(self.selector)
+        selector = self.selector
+        return cache.get(self.__selector.compile(), ttl, lambda: self.jsonrpc.objInfo(selector))
+
+    def cache_info(self, ttl=1.0):
+        '''
+        cache info of the object for ttl seconds, until any action changes
+        the device. ttl None means following the device setting.
+        Usage:
+        obj = d(text="Wi-Fi").cache_info(ttl=0.5)
+        obj.text, obj.bounds, obj.checked  # one objInfo call.
+        '''
+        self.__cache_ttl = ttl
+        return self
+
+    @property
+    def count(self):
+        '''number of matched ui objects, counted on one hierarchy snapshot.'''
+        return self.device.snapshot().count(self)
+
+    def all(self, by="snapshot"):
+        '''
+        return all matched ui objects, identified by instance, with their info
+        preloaded from one hierarchy snapshot, or from batches of objInfo calls
+        if by is "batch". Preloaded info is used until any action may change
+        the device, and then read again from device.
+        Usage:
+        for obj in d(className="android.widget.CheckBox"):
+            print obj.text, obj.checked  # no rpc call
+        d(className="android.widget.CheckBox").all()[2].click()
+        '''
+        if by not in ("batch", "snapshot"):
+            raise ValueError("by should be batch or snapshot.")
+        if self.__selector["childSelector"] is not None or self.__selector["fromParent"] is not None:
+            raise ValueError("all() does not support childSelector or fromParent.")
+        cache = self.device.server.info_cache
+        if by == "snapshot":
+            nodes = self.device.snapshot().find_all(self)
+            epoch = cache.epoch  # after the server is started by the first call
+            return [self.__instance(i, epoch, node.info) for i, node in enumerate(nodes)]
+        fixed = "instance" in _SelectorBuilder.criteria(self.__selector._dict)
+        objects = []
+        size = 1 if fixed else 8
+        while True:  # batches of doubled size, until any instance is not found.
+            candidates = [self.__instance(len(objects) + i) for i in range(size)]
+            with self.device.server.batch():
+                futures = [self.jsonrpc.objInfo(obj.selector) for obj in candidates]
+            epoch = cache.epoch
+            for obj, future in zip(candidates, futures):
+                if future.exception() is not None:
+                    return objects
+                obj.__preloaded = (epoch, future.result())
+                objects.append(obj)
+            if fixed:
+                return objects
+            size = min(size * 2, 64)
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def __instance(self, instance, epoch=None, info=None):
+        '''the ui object of the instance among matched objects, with preloaded info.'''
+        criteria = _SelectorBuilder.criteria(self.__selector._dict)
+        criteria.setdefault("instance", instance)
+        obj = type(self)(self.device, **criteria)
+        obj.__cache_ttl = self.__cache_ttl
+        if info is not None:
+            obj.__preloaded = (epoch, info)
+        return obj
 
     def set_text(self, text):
         '''set the text field.'''
         if text in [None, ""]:
-            self.jsonrpc.clearTextField(self.selector)  # TODO no return
+            return self.jsonrpc.clearTextField(self.selector)
         else:
             return self.jsonrpc.setText(self.selector, text)
 
     def clear_text(self):
         '''clear text. alias for set_text(None).'''
-        self.set_text(None)
+        return self.set_text(None)
 
-    @property
-    def click(self):
+    @_action_property(action=["tl", "topleft", "br", "bottomright", "wait"])
+    def click(self, action=None, timeout=3000):
         '''
         click on the ui object.
         Usage:
@@ -510,19 +2811,15 @@ class _AutomatorDeviceObject(object):
         d(text="John").click.topleft() # click on the topleft of the ui object
         d(text="John").click.bottomright() # click on the bottomright of the ui object
         '''
-        obj = self
-        @param_to_property(action=["tl", "topleft", "br", "bottomright", "wait"])
-        def _click(action=None, timeout=3000):
-            if action is None:
-                return obj.jsonrpc.click(obj.selector)
-            elif action in ["tl", "topleft", "br", "bottomright"]:
-                return obj.jsonrpc.click(obj.selector, action)
-            else:
-                return obj.jsonrpc.clickAndWaitForNewWindow(obj.selector, timeout)
-        return _click
+        if action is None:
+            return self.jsonrpc.click(self.selector)
+        elif action in ["tl", "topleft", "br", "bottomright"]:
+            return self.jsonrpc.click(self.selector, action)
+        else:
+            return self.jsonrpc.clickAndWaitForNewWindow(self.selector, timeout)
 
-    @property
-    def long_click(self):
+    @_action_property(corner=["tl", "topleft", "br", "bottomright"])
+    def long_click(self, corner=None):
         '''
         Perform a long click action on the object.
         Usage:
@@ -530,37 +2827,29 @@ class _AutomatorDeviceObject(object):
         d(text="Image").long_click.topleft()  # long click on the topleft of the ui object
         d(text="Image").long_click.bottomright()  # long click on the topleft of the ui object
         '''
-        obj = self
-
-        @param_to_property(corner=["tl", "topleft", "br", "bottomright"])
-        def _long_click(corner=None):
-            if corner is None:
-                return obj.jsonrpc.longClick(obj.selector)
-            else:
-                return obj.jsonrpc.longClick(obj.selector, corner)
-        return _long_click
+        if corner is None:
+            return self.jsonrpc.longClick(self.selector)
+        else:
+            return self.jsonrpc.longClick(self.selector, corner)
 
-    @property
-    def drag(self):
+    @_action_property(action=["to"])
+    def drag(self, *args, **kwargs):
         '''
         Drag the ui object to other point or ui object.
         Usage:
         d(text="Clock").drag.to(x=100, y=100)  # drag to point (x,y)
         d(text="Clock").drag.to(text="Remove") # drag to another object
         '''
-        obj = self
+        kwargs.pop("action", None)
+        if len(args) >= 2 or "x" in kwargs or "y" in kwargs:
+            return self.__drag_to_point(*args, **kwargs)
+        return self.__drag_to_object(*args, **kwargs)
 
-        class Drag(object):
+    def __drag_to_point(self, x, y, steps=100):
+        return self.jsonrpc.dragTo(self.selector, x, y, steps)
 
-            def to(self, *args, **kwargs):
-                if len(args) >= 2 or "x" in kwargs or "y" in kwargs:
-                    drag_to = lambda x, y, steps=100: obj.jsonrpc.dragTo(
-                        obj.selector, x, y, steps)
-                else:
-                    drag_to = lambda steps=100, **kwargs: obj.jsonrpc.dragTo(
-                        obj.selector, SelectorBuilder(**kwargs).build(), steps)
-                return drag_to(*args, **kwargs)
-        return Drag()
+    def __drag_to_object(self, steps=100, **kwargs):
+        return self.jsonrpc.dragTo(self.selector, SelectorBuilder(**kwargs).build(self.device.full_selector), steps)
 
     def gesture(self, start1, start2, *args, **kwargs):
         '''
@@ -569,43 +2858,28 @@ class _AutomatorDeviceObject(object):
         d().gesture(startPoint1, startPoint2).to(endPoint1, endPoint2, steps)
         d().gesture(startPoint1, startPoint2, endPoint1, endPoint2, steps)
         '''
-        obj = self
-
-        class Gesture(object):
-
-            def to(self, end1, end2, steps=100):
-                return obj.jsonrpc.gesture(obj.selector,
-                                           start1, start2,
-                                           end1, end2, steps)
         if len(args) == 0:
-            return Gesture()
+            return _Gesture(self, start1, start2)
         elif 3 >= len(args) >= 2:
-            f = lambda end1, end2, steps=100: obj.jsonrpc.gesture(
-                obj.selector, start1, start2, end1, end2, steps)
-            return f(*args, **kwargs)
+            return _Gesture(self, start1, start2).to(*args, **kwargs)
         else:
             raise SyntaxError("Invalid parameters.")
 
-    @property
-    def pinch(self):
+    @_action_property(in_or_out=["In", "Out"])
+    def pinch(self, in_or_out="Out", percent=100, steps=50):
         '''
         Perform two point gesture from edge to center(in) or center to edge(out).
         Usages:
         d().pinch.In(percent=100, steps=10)
         d().pinch.Out(percent=100, steps=100)
         '''
-        obj = self
+        if in_or_out in ["Out", "out"]:
+            return self.jsonrpc.pinchOut(self.selector, percent, steps)
+        elif in_or_out in ["In", "in"]:
+            return self.jsonrpc.pinchIn(self.selector, percent, steps)
 
-        @param_to_property(in_or_out=["In", "Out"])
-        def _pinch(in_or_out="Out", percent=100, steps=50):
-            if in_or_out in ["Out", "out"]:
-                return obj.jsonrpc.pinchOut(obj.selector, percent, steps)
-            elif in_or_out in ["In", "in"]:
-                return obj.jsonrpc.pinchIn(obj.selector, percent, steps)
-        return _pinch
-
-    @property
-    def swipe(self):
+    @_action_property(direction=["up", "down", "right", "left"])
+    def swipe(self, direction="left", steps=10):
         '''
         Perform swipe action.
         Usages:
@@ -615,15 +2889,13 @@ class _AutomatorDeviceObject(object):
         d().swipe.down()
         d().swipe("right", steps=20)
         '''
-        obj = self
+        return self.jsonrpc.swipe(self.selector, direction, steps)
 
-        @param_to_property(direction=["up", "down", "right", "left"])
-        def _swipe(direction="left", steps=10):
-            return obj.jsonrpc.swipe(obj.selector, direction, steps)
-        return _swipe
-
-    @property
-    def fling(self):
+    @_action_property(
+        dimention=["vert", "vertically", "vertical",
+                   "horiz", "horizental", "horizentally"],
+        action=["forward", "backward", "toBeginning", "toEnd"])
+    def fling(self, dimention="vert", action="forward", max_swipes=1000):
         '''
         Perform fling action.
         Usage:
@@ -633,27 +2905,21 @@ class _AutomatorDeviceObject(object):
         d().fling.toBeginning(max_swipes=100) # vertically
         d().fling.horiz.toEnd()
         '''
-        obj = self
-
-        @param_to_property(
-            dimention=["vert", "vertically", "vertical",
-                       "horiz", "horizental", "horizentally"],
-            action=["forward", "backward", "toBeginning", "toEnd"])
-        def _fling(dimention="vert", action="forward", max_swipes=1000):
-            vertical = dimention in ["vert", "vertically", "vertical"]
-            if action is "forward":
-                return obj.jsonrpc.flingForward(obj.selector, vertical)
-            elif action is "backward":
-                return obj.jsonrpc.flingBackward(obj.selector, vertical)
-            elif action is "toBeginning":
-                return obj.jsonrpc.flingToBeginning(obj.selector, vertical, max_swipes)
-            elif action is "toEnd":
-                return obj.jsonrpc.flingToEnd(obj.selector, vertical, max_swipes)
-
-        return _fling
-
-    @property
-    def scroll(self):
+        vertical = dimention in ["vert", "vertically", "vertical"]
+        if action == "forward":
+            return self.jsonrpc.flingForward(self.selector, vertical)
+        elif action == "backward":
+            return self.jsonrpc.flingBackward(self.selector, vertical)
+        elif action == "toBeginning":
+            return self.jsonrpc.flingToBeginning(self.selector, vertical, max_swipes)
+        elif action == "toEnd":
+            return self.jsonrpc.flingToEnd(self.selector, vertical, max_swipes)
+
+    @_action_property(
+        dimention=["vert", "vertically", "vertical",
+                   "horiz", "horizental", "horizentally"],
+        action=["forward", "backward", "toBeginning", "toEnd", "to", "iter"])
+    def scroll(self, *args, **kwargs):
         '''
         Perfrom scroll action.
         Usage:
@@ -663,53 +2929,1124 @@ class _AutomatorDeviceObject(object):
         d().scroll.horiz.toBeginning(steps=100, max_swipes=100)
         d().scroll.vert.toEnd(steps=100)
         d().scroll.horiz.to(text="Clock")
+        for node in d(scrollable=True).scroll.iter(resourceId="android:id/title"):
+            node["text"]  # each item once, until the list ends
         '''
-        obj = self
+        args = list(args)
+        if kwargs.get("action") != "iter":  # positional arguments of scroll.iter are its own.
+            for name in ["dimention", "action"]:
+                if args and name not in kwargs:
+                    kwargs[name] = args.pop(0)
+        dimention, action = kwargs.pop("dimention", "vert"), kwargs.pop("action", "forward")
+        if args and action != "iter":
+            raise TypeError("scroll() takes at most 2 positional arguments, dimention and action.")
+        if dimention in ["vert", "vertically", "vertical"]:
+            vertical = True
+        elif dimention in ["horiz", "horizental", "horizentally"]:
+            vertical = False
+        else:
+            raise TypeError("unknown scroll dimention %r." % (dimention,))
+        if action in ["forward", "backward"]:
+            return self.__scroll(vertical, action == "forward", **kwargs)
+        elif action == "toBeginning":
+            return self.__scroll_to_beginning(vertical, **kwargs)
+        elif action == "toEnd":
+            return self.__scroll_to_end(vertical, **kwargs)
+        elif action == "to":
+            return self.__scroll_to(vertical, **kwargs)
+        elif action == "iter":
+            return self.__scroll_iter(vertical, *args, **kwargs)
+        raise TypeError("unknown scroll action %r." % (action,))
+
+    def __scroll(self, vertical, forward, steps=100):
+        if forward:
+            return self.jsonrpc.scrollForward(self.selector, vertical, steps)
+        return self.jsonrpc.scrollBackward(self.selector, vertical, steps)
+
+    def __scroll_to_beginning(self, vertical, steps=100, max_swipes=1000):
+        return self.jsonrpc.scrollToBeginning(self.selector, vertical, max_swipes, steps)
+
+    def __scroll_to_end(self, vertical, steps=100, max_swipes=1000):
+        return self.jsonrpc.scrollToEnd(self.selector, vertical, max_swipes, steps)
+
+    def __scroll_to(self, vertical, **kwargs):
+        return self.jsonrpc.scrollTo(self.selector, SelectorBuilder(**kwargs).build(self.device.full_selector), vertical)
+
+    def __scroll_iter(self, vertical, selector=None, key=None, steps=100, max_swipes=1000, **kwargs):
+        return self.__iter_scrolled(vertical, _build_selector(selector, **kwargs), key or operator.attrgetter("hash"),
+                                    steps, max_swipes)
+
+    def __iter_scrolled(self, vertical, selector, key, steps, max_swipes):
+        '''
+        yield snapshot nodes of items in the scrollable object, scrolling
+        forward on demand. Each step takes one snapshot, and it stops once a
+        step reveals no new item or the end is reached. Items are told apart
+        by key (merkle hash of item subtree by default) and, for identical
+        ones, by their order in the snapshot. Items of the previous step are
+        not yielded again.
+        '''
+        previous = set()
+        scrolled = True  # the first step is taken without scrolling.
+        for swipe in range(max_swipes + 1):
+            snapshot = self.device.snapshot()
+            containers = snapshot.find_all(self)
+            current, occurrences = set(), collections.Counter()
+            new = 0
+            for node in snapshot.find_all(selector):
+                if not any(c.contains(node) for c in containers):
+                    continue
+                k = key(node)
+                k = (k, occurrences[k])  # identical items are distinct within a snapshot.
+                occurrences[k[0]] += 1
+                current.add(k)
+                if k in previous:
+                    continue
+                new += 1
+                yield node
+            if swipe > 0 and (new == 0 or not scrolled):
+                return
+            previous = current
+            scrolled = self.jsonrpc.scrollForward(self.selector, vertical, steps)
+
+    @_action_property(action=["exist", "gone"])
+    def wait(self, action, timeout=3000):
+        '''
+        Wait until the ui object gone or exist.
+        Usage:
+        d(text="Clock").wait.gone()  # wait until it's gone.
+        d(text="Settings").wait.exist() # wait until it appears.
+        '''
+        if action == "exist":
+            return self.jsonrpc.waitForExists(self.selector, timeout)
+        elif action == "gone":
+            return self.jsonrpc.waitUntilGone(self.selector, timeout)
+
+
+class _Gesture(object):
+
+    '''two point gesture of a ui object, performed by to(end1, end2, steps).'''
 
-        def __scroll(vertical, forward, steps=100):
-            return obj.jsonrpc.scrollForward(obj.selector, vertical, steps) if forward else obj.jsonrpc.scrollBackward(obj.selector, vertical, steps)
+    __slots__ = ["obj", "start1", "start2"]
 
-        def __scroll_to_beginning(vertical, steps=100, max_swipes=1000):
-            return obj.jsonrpc.scrollToBeginning(obj.selector, vertical, max_swipes, steps)
+    def __init__(self, obj, start1, start2):
+        self.obj = obj
+        self.start1 = start1
+        self.start2 = start2
 
-        def __scroll_to_end(vertical, steps=100, max_swipes=1000):
-            return obj.jsonrpc.scrollToEnd(obj.selector, vertical, max_swipes, steps)
+    def to(self, end1, end2, steps=100):
+        obj = self.obj
+        return obj.jsonrpc.gesture(obj.selector, self.start1, self.start2, end1, end2, steps)
+
+
+class _CaptureStream(object):
+
+    '''
+    iterator of screenshots in png data, captured at most fps frames per
+    second over one adb sync connection. Frames are dropped instead of
+    queued if the consumer is slower than fps.
+    '''
 
-        def __scroll_to(vertical, **kwargs):
-            return obj.jsonrpc.scrollTo(obj.selector, SelectorBuilder(**kwargs).build(), vertical)
+    def __init__(self, device, fps=10, scale=1.0, quality=100):
+        self.__device = device
+        self.__interval = 1.0 / fps
+        self.__scale = scale
+        self.__quality = quality
+        self.__sync = None
+        self.__device_file = None
+        self.__due = None
+        self.__started = None
+        self.__elapsed = 0.0
+        self.frames = 0
+        self.dropped = 0
+        self.latency = 0.0
+
+    def __iter__(self):
+        return self
 
-        @param_to_property(
-            dimention=["vert", "vertically", "vertical",
-                       "horiz", "horizental", "horizentally"],
-            action=["forward", "backward", "toBeginning", "toEnd", "to"])
-        def _scroll(dimention="vert", action="forward", **kwargs):
-            vertical = dimention in ["vert", "vertically", "vertical"]
-            if action in ["forward", "backward"]:
-                return __scroll(vertical, action is "forward", **kwargs)
-            elif action is "toBeginning":
-                return __scroll_to_beginning(vertical, **kwargs)
-            elif action is "toEnd":
-                return __scroll_to_end(vertical, **kwargs)
-            elif action is "to":
-                return __scroll_to(vertical, **kwargs)
-        return _scroll
+    def next(self):
+        now = time.time()
+        if self.__due is None:
+            self.__started = now
+        elif now < self.__due:
+            time.sleep(self.__due - now)
+        else:
+            self.dropped += int((now - self.__due) / self.__interval)
+        start = time.time()
+        self.__device_file = self.__device.server.jsonrpc.takeScreenshot(
+            "screenshot.png", self.__scale, self.__quality)
+        if self.__device_file is None or len(self.__device_file) is 0:
+            raise StopIteration
+        data = self.__read(self.__device_file)
+        end = time.time()
+        self.__due = start + self.__interval
+        self.__elapsed = end - self.__started
+        self.latency = (self.latency * self.frames + end - start) / (self.frames + 1)
+        self.frames += 1
+        return data
+
+    def __read(self, device_file):
+        session = self.__device.server.session
+        if session is not None:
+            return session.pull(device_file, lambda: self.__pull(device_file))
+        return self.__pull(device_file)
+
+    def __pull(self, device_file):
+        if self.__sync is None:
+            try:
+                self.__sync = AdbClient(self.__device.serial).sync()
+            except socket.error:
+                return adb_read(device_file, serial=self.__device.serial)
+        return self.__sync.pull(device_file)
 
     @property
-    def wait(self):
+    def fps(self):
+        '''achieved frames per second.'''
+        return self.frames / self.__elapsed if self.__elapsed else 0.0
+
+    def close(self):
+        if self.__sync is not None:
+            self.__sync.close()
+            self.__sync = None
+        session = self.__device.server.session
+        if self.__device_file and not (session is not None and session.replaying):
+            adb_shell("rm", self.__device_file, serial=self.__device.serial)
+        self.__device_file = None
+
+
+class _Watcher(object):
+
+    '''watcher acting once its selector matches, and the times it was triggered.'''
+
+    def __init__(self, name, selector, action):
+        self.name = name
+        self.selector = selector
+        self.action = action
+        self.count = 0
+
+    def act(self, device, node):
         '''
-        Wait until the ui object gone or exist.
-        Usage:
-        d(text="Clock").wait.gone()  # wait until it's gone.
-        d(text="Settings").wait.exist() # wait until it appears.
+        act on the matched node: "click" clicks its center, "back" presses the
+        back key, a ui object is clicked, and other callables are called.
+        '''
+        if self.action == "click":
+            bounds = node["bounds"]
+            device.click((bounds["left"] + bounds["right"]) / 2, (bounds["top"] + bounds["bottom"]) / 2)
+        elif self.action == "back":
+            device.press.back()
+        elif isinstance(self.action, _AutomatorDeviceObject):
+            self.action.click()
+        else:
+            self.action()
+
+
+class _Watchers(object):
+
+    '''
+    client side watchers of a device. A background thread takes a hierarchy
+    snapshot at most every interval seconds, or reuses the last snapshot of
+    the device if no action happened since, and checks all watchers against
+    it in one pass. The first matched watcher acts, and the pass ends since
+    the screen changes. Passes are skipped while the rpc server is not alive,
+    so watchers never start the server, e.g. once it's stopped.
+    '''
+
+    def __init__(self, device, interval=1.0):
+        self.__device = device
+        self.__watchers = collections.OrderedDict()
+        self.__lock = threading.RLock()  # held by a pass, and by pause to wait for the pass
+        self.__paused = 0
+        self.__stopped = threading.Event()
+        self.__thread = None
+        self.__checked = None  # the snapshot checked last, if nothing matched on it.
+        self.interval = interval
+        self.passes = 0  # passes which checked watchers on a snapshot
+        self.dumps = 0  # snapshots dumped by watchers, others were reused
+        self.errors = 0
+        self.last_error = None
+
+    def register(self, name, when, do="click"):
+        '''
+        register or replace the watcher, which does the action once the
+        selector when matches, and start the background thread if not yet.
+        do is "click" (the matched object, by default), "back", a ui object
+        to click, or a callable.
+        '''
+        with self.__lock:
+            self.__watchers[name] = _Watcher(name, _build_selector(when), do)
+            self.__checked = None
+        self.start()
+        return self
+
+    def remove(self, name=None):
+        '''remove the watcher, or all watchers if name is None.'''
+        with self.__lock:
+            if name is None:
+                self.__watchers.clear()
+            else:
+                self.__watchers.pop(name, None)
+
+    def __getitem__(self, name):
+        return self.__watchers[name]
+
+    def __contains__(self, name):
+        return name in self.__watchers
+
+    def __iter__(self):
+        return iter(list(self.__watchers))
+
+    def __len__(self):
+        return len(self.__watchers)
+
+    @property
+    def counts(self):
+        '''times each watcher was triggered.'''
+        return dict((name, w.count) for name, w in self.__watchers.items())
+
+    def reset(self):
+        '''reset trigger counts.'''
+        for w in self.__watchers.values():
+            w.count = 0
+
+    def pause(self):
+        '''pause watchers until resume, waiting for the running pass if any.'''
+        with self.__lock:
+            self.__paused += 1
+
+    def resume(self):
+        with self.__lock:
+            self.__paused = max(self.__paused - 1, 0)
+
+    @property
+    def running(self):
+        '''whether the background thread is checking watchers, i.e. started and not paused.'''
+        return self.__thread is not None and self.__thread.is_alive() and not self.__paused
+
+    @contextlib.contextmanager
+    def paused(self):
+        '''pause watchers in the with block, which may be nested.'''
+        self.pause()
+        try:
+            yield self
+        finally:
+            self.resume()
+
+    def start(self, interval=None):
+        '''start the background thread, checking watchers at most every interval seconds.'''
+        if interval is not None:
+            self.interval = interval
+        with self.__lock:
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__stopped.clear()
+                self.__thread = threading.Thread(target=self.__run, name="watchers-%s" % self.__device.serial)
+                self.__thread.daemon = True
+                self.__thread.start()
+
+    def stop(self):
+        '''stop the background thread, and wait for the running pass.'''
+        self.__stopped.set()
+        thread, self.__thread = self.__thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def __run(self):
+        while not self.__stopped.wait(self.interval):
+            if self.__paused or not self.__watchers or self.__device.server.state != _AutomatorServer.ALIVE:
+                continue
+            try:
+                self.check()
+            except Exception as e:  # e.g. device is disconnected, try again in next pass.
+                self.errors += 1
+                self.last_error = e
+
+    def check(self, snapshot=None):
+        '''
+        check all watchers in one pass on the snapshot, a fresh one by default,
+        and return the name of the watcher which acted, or None.
+        '''
+        with self.__lock:
+            if self.__paused:
+                return None
+            if snapshot is None:
+                snapshot = self.__snapshot()
+            if self.__checked is not None and snapshot.unchanged(self.__checked):
+                return None  # nothing matched on the same hierarchy.
+            self.passes += 1
+            for watcher in self.__watchers.values():
+                nodes = snapshot.find_all(watcher.selector)
+                if nodes:
+                    self.__checked = None
+                    watcher.count += 1
+                    watcher.act(self.__device, nodes[0])
+                    return watcher.name
+            self.__checked = snapshot
+            return None
+
+    def __snapshot(self):
+        '''the last snapshot of the device if it's recent and no action happened since, or a new one.'''
+        last = self.__device._last_snapshot
+        if last is not None:
+            epoch, taken, snapshot = last
+            if epoch == self.__device.server.info_cache.epoch and time.time() - taken < self.interval:
+                return snapshot
+        self.dumps += 1
+        return self.__device.snapshot()
+
+
+Device = _AutomatorDevice
+
+
+class DevicePool(object):
+
+    '''
+    A pool of devices, which runs a callable across all devices on a thread pool.
+    Usage:
+    pool = DevicePool()  # all attached devices
+    pool = DevicePool(["014E05DE0F02000E", "015d2994ec2c0a0b"])
+    pool.map(lambda d: d.info)  # {serial: info}
+    pool.map(lambda d, text: d(text=text).click(), "Settings")
+    '''
+
+    def __init__(self, serials=None, processes=None):
+        if serials is None:
+            serials = [serial for serial, state in adb_devices().items() if state == "device"]
+        self.devices = dict((serial, Device(serial)) for serial in serials)
+        self.__processes = processes
+
+    def __getitem__(self, serial):
+        return self.devices[serial]
+
+    def __iter__(self):
+        return iter(self.devices.values())
+
+    def __len__(self):
+        return len(self.devices)
+
+    def map(self, func, *args, **kwargs):
+        '''
+        call func(device, *args, **kwargs) on all devices concurrently, and
+        return a dict of serial to result, or to the exception raised.
+        '''
+        pool = ThreadPool(self.__processes or max(len(self.devices), 1))
+        try:
+            results = dict((serial, pool.apply_async(_call_catching, (func, device) + args, kwargs))
+                           for serial, device in self.devices.items())
+            return dict((serial, result.get()) for serial, result in results.items())
+        finally:
+            pool.close()
+            pool.join()
+
+    def stop(self):
+        '''stop rpc servers on all devices.'''
+        self.map(lambda device: device.server.stop())
+
+
+class LatencyHistogram(object):
+
+    '''
+    HDR style histogram of latencies in microseconds. Each power of 2 range
+    is split into linear sub buckets, so values are recorded in constant time
+    and space, with relative error below 2 / sub_buckets.
+    '''
+
+    def __init__(self, sub_buckets=128):
+        self.__bits = max(int(sub_buckets - 1).bit_length(), 1)
+        self.counts = collections.defaultdict(int)  # (exponent, sub bucket): count
+        self.count = 0
+        self.total = 0.0
+        self.min = self.max = None
+
+    def record(self, seconds):
+        us = max(int(seconds * 1000000), 0)
+        exponent = max(us.bit_length() - self.__bits, 0)
+        self.counts[(exponent, us >> exponent)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        '''latency in seconds at percentile p (0-100).'''
+        if self.count == 0:
+            return None
+        rank = max(self.count * p / 100.0, 1)
+        seen = 0
+        for (exponent, sub), count in sorted(self.counts.items()):
+            seen += count
+            if seen >= rank:
+                value = ((sub << exponent) + ((1 << exponent) - 1) / 2.0) / 1000000
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        '''count, and mean, min, max and percentiles in milliseconds.'''
+        if self.count == 0:
+            return {"count": 0}
+        s = {"count": self.count, "mean": self.total / self.count * 1000,
+             "min": self.min * 1000, "max": self.max * 1000}
+        for p in (50, 90, 99, 99.9):
+            s["p%s" % ("%g" % p).replace(".", "")] = self.percentile(p) * 1000
+        return s
+
+
+class Profiler(object):
+
+    '''
+    hook which collects latency histograms per kind and name of calls, and
+    trace events exportable in chrome trace format (chrome://tracing).
+    Usage:
+    with Profiler() as profiler:  # or d.server.hooks.append(profiler)
+        d(text="Settings").click()
+    profiler.summary()  # {"rpc:click": {"count": 1, "mean": 12.3, "p50": ...}, "adb:shell": ...}
+    profiler.chrome_trace("trace.json")
+    '''
+
+    def __init__(self, max_events=100000):
+        self.histograms = collections.defaultdict(LatencyHistogram)
+        self.errors = collections.defaultdict(int)
+        self.bytes = collections.defaultdict(int)
+        self.events = collections.deque(maxlen=max_events)
+        self.__lock = threading.Lock()
+
+    def __call__(self, event):
+        key = "%s:%s" % (event.kind, event.name)
+        with self.__lock:
+            self.histograms[key].record(event.duration)
+            if event.error is not None:
+                self.errors[key] += 1
+            self.bytes[key] += (event.sent or 0) + (event.received or 0)
+            self.events.append(event)
+
+    def __enter__(self):
+        add_hook(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        remove_hook(self)
+
+    def summary(self):
+        '''dict of "kind:name" to latency summary, with errors and bytes.'''
+        with self.__lock:
+            result = {}
+            for key, histogram in self.histograms.items():
+                result[key] = histogram.summary()
+                result[key]["errors"] = self.errors[key]
+                result[key]["bytes"] = self.bytes[key]
+            return result
+
+    def chrome_trace(self, filename=None):
+        '''return trace in chrome trace event format, and write it to file if filename is given.'''
+        with self.__lock:
+            events = list(self.events)
+        pid = os.getpid()
+        trace = {"traceEvents": [{
+            "name": e.name,
+            "cat": e.kind,
+            "ph": "X",
+            "ts": e.start * 1000000,
+            "dur": e.duration * 1000000,
+            "pid": pid,
+            "tid": e.thread,
+            "args": {"serial": e.serial, "sent": e.sent, "received": e.received, "connected": e.connected,
+                     "error": None if e.error is None else repr(e.error)}
+        } for e in events], "displayTimeUnit": "ms"}
+        if filename is not None:
+            with open(filename, "w") as f:
+                json.dump(trace, f)
+        return trace
+
+
+def _call_catching(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        return e
+
+
+def _coroutine(func):
+    return asyncio.coroutine(func) if asyncio is not None else func
+
+
+@_coroutine
+def async_adb_cmd(*args, **kwargs):
+    '''run adb command in asyncio subprocess, and return (returncode, stdout).'''
+    serial, loop = kwargs.get("serial"), kwargs.get("loop")
+    if serial:
+        args = ("-s", serial) + args
+    p = yield From(asyncio.create_subprocess_exec(get_adb(), *args, stdout=subprocess.PIPE,
+                                                  stderr=subprocess.PIPE, loop=loop))
+    out, err = yield From(p.communicate())
+    raise Return((p.returncode, out))
+
+
+class _NotWritten(socket.error):
+
+    '''the connection failed before the request was written, so it's safe to send again.'''
+
+
+# errors of asyncio streams, which are OSError of trollius on python 2.
+_async_transport_errors = _transport_errors + (OSError,)
+
+
+class _AsyncJsonRpcTransport(object):
+
+    '''
+    HTTP/1.1 keep-alive transport on asyncio streams. Each request takes an
+    idle connection or opens a new one, so concurrent coroutines never share
+    a stream.
+    '''
+
+    def __init__(self, loop=None):
+        self.__loop = loop
+        self.__idle = []  # (reader, writer) of idle kept-alive connections
+
+    def __take(self):
+        '''an idle connection which is not closed by the server, None if no one.'''
+        while self.__idle:
+            reader, writer = self.__idle.pop()
+            if not reader.at_eof() and reader.exception() is None:
+                return reader, writer
+            writer.close()
+        return None
+
+    @_coroutine
+    def request(self, host, port, handler, request_body, idempotent=False):
+        '''
+        post the request body and return the response body. A request failed
+        on a kept-alive connection is sent again on a new connection only if
+        it's idempotent, since the server may have done it.
+        '''
+        for retry in (False, True):
+            conn = self.__take()
+            reused = conn is not None
+            if not reused:
+                try:
+                    conn = yield From(asyncio.open_connection(host, port, loop=self.__loop))
+                except _async_transport_errors as e:
+                    raise _NotWritten(*e.args)
+            reader, writer = conn
+            try:
+                status, reason, headers, body = yield From(
+                    self.__exchange(reader, writer, host, port, handler, request_body))
+                break
+            except _async_transport_errors:
+                writer.close()
+                # kept-alive connection may have been closed by the server.
+                if retry or not reused or not idempotent:
+                    raise
+            except BaseException:  # e.g. cancelled, the response may still come.
+                writer.close()
+                raise
+        if headers.get("connection", "").lower() == "close" or "content-length" not in headers:
+            writer.close()
+        else:
+            self.__idle.append((reader, writer))
+        if status != 200:
+            raise xmlrpclib.ProtocolError("%s:%d%s" % (host, port, handler), status, reason, headers)
+        raise Return(_decode_content(body, headers.get("content-encoding")))
+
+    @_coroutine
+    def __exchange(self, reader, writer, host, port, handler, request_body):
+        writer.write("POST %s HTTP/1.1\r\n"
+                     "Host: %s:%d\r\n"
+                     "Accept-Encoding: gzip, deflate\r\n"
+                     "Content-Type: application/json-rpc\r\n"
+                     "Content-Length: %d\r\n\r\n%s" % (handler, host, port, len(request_body), request_body))
+        try:
+            status_line = yield From(reader.readline())
+            if not status_line:
+                raise httplib.BadStatusLine(status_line)
+            version, status, reason = (status_line.strip().split(None, 2) + [""])[:3]
+            headers = {}
+            while True:
+                line = yield From(reader.readline())
+                if line.strip() == "":
+                    break
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+            if "content-length" in headers:
+                body = yield From(reader.readexactly(int(headers["content-length"])))
+            else:
+                body = yield From(reader.read())
+        except EOFError as e:
+            raise httplib.IncompleteRead(getattr(e, "partial", ""))
+        raise Return((int(status), reason, headers, body))
+
+    def close(self):
+        '''close idle connections, those in use are closed once their requests are done.'''
+        idle, self.__idle = self.__idle, []
+        for reader, writer in idle:
+            writer.close()
+
+
+class _AsyncAutomatorServer(object):
+
+    """start rpc server on device and call rpc methods in asyncio coroutines.
+    """
+    STOPPED, STARTING, ALIVE, DEAD = "stopped", "starting", "alive", "dead"
+
+    def __init__(self, serial=None, local_port=None, loop=None):
+        if asyncio is None:
+            raise ImportError("trollius is required by AsyncDevice.")
+        self.__loop = loop or asyncio.get_event_loop()
+        self.__automator_process = None
+        self.__serial = serial or os.environ.get("ANDROID_SERIAL")
+        if local_port is None:
+            local_port = 9008 if serial is None else next_local_port()
+        self.__local_port = local_port
+        self.__device_port = 9008
+        self.__transport = _AsyncJsonRpcTransport(self.__loop)
+        self.__ids = itertools.count(1)
+        self.__state = self.STOPPED
+        self.__start_lock = asyncio.Lock(loop=self.__loop)  # concurrent first calls start the server once.
+        self.__generation = 0  # increased by each start, so a failed call restarts the server once.
+        self.jsonrpc = _JsonRpcProxy(self)
+
+    @property
+    def serial(self):
+        return self.__serial
+
+    @property
+    def state(self):
+        return self.__state
+
+    @_coroutine
+    def call(self, method, *args, **kwargs):
+        '''
+        invoke the rpc method, the server is started or restarted if necessary.
+        A call failed after its request was written is sent again only if it's
+        an idempotent read, since the server may have done it. Arguments are
+        positional or keyword ones, not both, as in JSON-RPC.
         '''
-        obj = self
+        if args and kwargs:
+            raise jsonrpclib.jsonrpc.ProtocolError("Cannot use both positional and keyword arguments.")
+        args = kwargs or args
+        generation = self.__generation
+        if self.__state != self.ALIVE:
+            generation = yield From(self.__ensure_alive(generation))
+        idempotent = method in _idempotent_methods
+        try:
+            result = yield From(self.__invoke(method, args, idempotent))
+        except _async_transport_errors as e:
+            yield From(self.__ensure_alive(generation, restart=True))
+            if not idempotent and not isinstance(e, _NotWritten):
+                raise
+            result = yield From(self.__invoke(method, args, idempotent))
+        raise Return(result)
+
+    @_coroutine
+    def __ensure_alive(self, generation, restart=False):
+        '''
+        start the server unless it's alive or started by other coroutines
+        since generation, and return the generation.
+        '''
+        yield From(self.__start_lock.acquire())
+        try:
+            if generation == self.__generation:
+                if (yield From(self.__can_ping())):
+                    self.__state = self.ALIVE
+                    if not restart:
+                        self.__generation += 1
+                else:
+                    yield From(self.start())
+        finally:
+            self.__start_lock.release()
+        raise Return(self.__generation)
+
+    @_coroutine
+    def __invoke(self, method, args, idempotent=True):
+        request = jsonrpclib.dumps(args, method, rpcid=next(self.__ids), version=2.0)
+        try:
+            response = yield From(self.__transport.request("localhost", self.__local_port,
+                                                           "/jsonrpc/device", request, idempotent))
+        except _async_transport_errors:
+            self.__state = self.DEAD
+            raise
+        self.__state = self.ALIVE
+        response = jsonrpclib.loads(response)
+        jsonrpclib.jsonrpc.check_for_errors(response)
+        raise Return(response["result"])
+
+    @_coroutine
+    def __can_ping(self):
+        try:
+            pong = yield From(self.__invoke("ping", ()))
+        except Exception:
+            pong = None
+        raise Return(pong == "pong")
+
+    @_coroutine
+    def adb_cmd(self, *args):
+        result = yield From(async_adb_cmd(*args, serial=self.__serial, loop=self.__loop))
+        raise Return(result)
+
+    @_coroutine
+    def start(self, timeout=30):
+        self.__state = self.STARTING
+        try:
+            yield From(self.__start(timeout))
+        except:
+            self.__state = self.STOPPED
+            raise
+        self.__generation += 1
+        self.__state = self.ALIVE
+
+    @_coroutine
+    def __start(self, timeout):
+        returncode, out = yield From(async_adb_cmd("devices", loop=self.__loop))
+        _check_attached(_parse_devices(out), self.__serial)
+        jars = yield From(self.__loop.run_in_executor(None, _download_jars))
+        yield From(asyncio.gather(*[self.__loop.run_in_executor(None, _push_if_changed, path,
+                                                                _jar_device_path + name, self.__serial)
+                                    for name, path in jars.items()], loop=self.__loop))
+        args = _runtest_args(jars)
+        if self.__serial:
+            args = ["-s", self.__serial] + args
+        self.__automator_process = yield From(asyncio.create_subprocess_exec(
+            get_adb(), *args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, loop=self.__loop))
+        yield From(self.adb_cmd("forward", "tcp:%d" % self.__local_port, "tcp:%d" % self.__device_port))
+        self.__transport.close()
+        deadline = self.__loop.time() + timeout
+        interval = 0.05
+        while not (yield From(self.__can_ping())):
+            if self.__automator_process.returncode is not None:
+                raise EnvironmentError("RPC server exited with code %d." % self.__automator_process.returncode)
+            remaining = deadline - self.__loop.time()
+            if remaining <= 0:
+                raise EnvironmentError("RPC server is not ready in %s seconds." % timeout)
+            yield From(asyncio.sleep(min(interval, remaining), loop=self.__loop))
+            interval = min(interval * 2, 0.5)
+
+    @_coroutine
+    def stop(self):
+        '''Stop the rpc server.'''
+        if self.__automator_process is not None and self.__automator_process.returncode is None:
+            try:
+                yield From(self.__loop.run_in_executor(None, urllib2.urlopen, self.stop_uri, None, 5))
+                yield From(self.__automator_process.wait())
+            except Exception:
+                self.__automator_process.kill()
+            finally:
+                self.__automator_process = None
+        self.__transport.close()
+        self.__state = self.STOPPED
+
+    @property
+    def stop_uri(self):
+        return "http://localhost:%d/stop" % self.__local_port
+
+
+class _Unsupported(object):
+
+    '''attribute of sync devices and ui objects, which is hidden in asyncio ones.'''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        raise AttributeError("%s is not supported by %s, use the sync one instead." % (self.name, owner.__name__))
+
+
+class AsyncDevice(_AutomatorDevice):
+
+    '''
+    asyncio version of device, whose rpc methods return coroutines.
+    Usage:
+    d = AsyncDevice("014E05DE0F02000E")
+    info = yield From(d.info)
+    yield From(d(text="Settings").click())
+    yield From(d.press.back())
+    '''
+
+    # based on sync calls, hierarchy snapshots or the info cache.
+    record = _Unsupported("record")
+    replay = _Unsupported("replay")
+    batch = _Unsupported("batch")
+    info_cache = _Unsupported("info_cache")
+    cache_info = _Unsupported("cache_info")
+    snapshot = _Unsupported("snapshot")
+    capture_stream = _Unsupported("capture_stream")
+    watchers = _Unsupported("watchers")
+
+    def __init__(self, serial=None, local_port=None, loop=None):
+        self.server = _AsyncAutomatorServer(serial, local_port, loop)
+
+    def __call__(self, **kwargs):
+        return AsyncDeviceObject(self, **kwargs)
+
+    @_action_property(action=["idle", "update"])
+    def wait(self, *selectors, **kwargs):
+        '''wait for idle or window update, see _AutomatorDevice.wait. wait.any and wait.all are not supported.'''
+        if kwargs.get("action", selectors[0] if selectors else None) in ["any", "all"]:
+            raise TypeError("wait.any and wait.all are not supported by AsyncDevice, use the sync one instead.")
+        return _AutomatorDevice.wait.func(self, *selectors, **kwargs)
+
+    @property
+    @_coroutine
+    def orientation(self):
+        '''get orientation of the device, see _AutomatorDevice.orientation.'''
+        info = yield From(self.info)
+        raise Return(self._orientation[info["displayRotation"]][1])
+
+    @orientation.setter
+    def orientation(self, value):
+        raise AttributeError("orientation of AsyncDevice can not be set, use yield From(d.set_orientation(value)).")
+
+    def set_orientation(self, value):
+        '''set orientation, see _AutomatorDevice.orientation, and return the coroutine of the call.'''
+        for values in self._orientation:
+            if value in values:
+                return self.server.jsonrpc.setOrientation(values[1])
+        raise ValueError("Invalid orientation.")
+
+    @_coroutine
+    def __pull(self, device_file, filename):
+        if device_file is None or len(device_file) is 0:
+            raise Return(None)
+        returncode, out = yield From(self.server.adb_cmd("pull", device_file, filename))
+        yield From(self.server.adb_cmd("shell", "rm", device_file))
+        raise Return(filename if returncode is 0 else None)
+
+    @_coroutine
+    def dump(self, filename):
+        '''dump device window and pull to local file.'''
+        device_file = yield From(self.server.jsonrpc.dumpWindowHierarchy(True, "dump.xml"))
+        result = yield From(self.__pull(device_file, filename))
+        raise Return(result)
+
+    @_coroutine
+    def screenshot(self, filename, scale=1.0, quality=100):
+        '''take screenshot.'''
+        device_file = yield From(self.server.jsonrpc.takeScreenshot("screenshot.png", scale, quality))
+        result = yield From(self.__pull(device_file, filename))
+        raise Return(result)
+
+
+class AsyncDeviceObject(_AutomatorDeviceObject):
+
+    '''asyncio version of ui object, whose actions return coroutines.'''
+
+    # based on hierarchy snapshots or the info cache.
+    count = _Unsupported("count")
+    all = _Unsupported("all")
+    cache_info = _Unsupported("cache_info")
+
+    def __iter__(self):
+        raise TypeError("AsyncDeviceObject is not iterable, use the sync one instead.")
+
+    @_action_property(
+        dimention=["vert", "vertically", "vertical", "horiz", "horizental", "horizentally"],
+        action=["forward", "backward", "toBeginning", "toEnd", "to"])
+    def scroll(self, *args, **kwargs):
+        '''perform scroll action, see _AutomatorDeviceObject.scroll. scroll.iter is not supported.'''
+        if kwargs.get("action", args[1] if len(args) > 1 else None) == "iter":
+            raise TypeError("scroll.iter is not supported by AsyncDeviceObject, use the sync one instead.")
+        return _AutomatorDeviceObject.scroll.func(self, *args, **kwargs)
+
+    @property
+    def info(self):
+        '''ui object info.'''
+        return self.jsonrpc.objInfo(self.selector)
+
+    def __getattribute__(self, attr):
+        # no alias of info fields, since they can not be retrieved synchronously.
+        return object.__getattribute__(self, attr)
 
-        @param_to_property(action=["exist", "gone"])
-        def _wait(action, timeout=3000):
-            if action is "exist":
-                return obj.jsonrpc.waitForExists(obj.selector, timeout)
-            elif action is "gone":
-                return obj.jsonrpc.waitUntilGone(obj.selector, timeout)
-        return _wait
 
 device = _AutomatorDevice()
+
+
+def _parse_selector(args):
+    '''parse selector from command line arguments like "text=OK checked=true".'''
+    defaults = SelectorBuilder.defaults()
+    selector = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep or key not in defaults or key == "mask":
+            raise ValueError("invalid selector argument: %s" % arg)
+        if defaults[key] is False:
+            value = value.lower() in ("true", "1", "yes")
+        elif defaults[key] == 0:
+            value = int(value)
+        selector[key] = value
+    return selector
+
+
+class _CommandSession(object):
+
+    '''devices and snapshots kept between commands of the command line.'''
+
+    def __init__(self):
+        self.devices = {}
+        self.snapshots = {}
+
+    def device(self, serial):
+        if serial not in self.devices:
+            self.devices[serial] = _AutomatorDevice(serial)
+        return self.devices[serial]
+
+    def snapshot(self, serial, refresh=False):
+        if refresh or serial not in self.snapshots:
+            self.snapshots[serial] = self.device(serial).snapshot()
+        return self.snapshots[serial]
+
+    def run(self, serial, command, args, snapshot=False):
+        '''run the command, and return its result which could be encoded in json.'''
+        d = self.device(serial)
+        if command == "click":
+            if len(args) == 2 and all(arg.isdigit() for arg in args):
+                return d.click(int(args[0]), int(args[1]))
+            return d(**_parse_selector(args)).click()
+        elif command == "press":
+            key = args[0]
+            return d.press(int(key, 0) if key[:1].isdigit() else key)
+        elif command == "dump":
+            self.snapshots[serial] = snapshot = d.snapshot()
+            return snapshot.xml
+        elif command == "screenshot":
+            png = d.screenshot()
+            if png is None:
+                raise EnvironmentError("Failed to take screenshot.")
+            return base64.b64encode(png)
+        elif command == "info":
+            if not args:
+                return d.info
+            if snapshot:
+                return self.snapshot(serial).info(**_parse_selector(args))
+            return d(**_parse_selector(args)).info
+        elif command == "exist":
+            if snapshot:
+                return self.snapshot(serial).exist(**_parse_selector(args))
+            return d(**_parse_selector(args)).exist()
+        elif command == "snapshot":
+            return len(self.snapshot(serial, refresh=True).nodes)
+        raise ValueError("unknown command: %s" % command)
+
+
+def _daemon_socket():
+    return os.environ.get("UIAUTOMATOR_SOCKET") or \
+        os.path.join(tempfile.gettempdir(), "uiautomator-%d.sock" % os.getuid())
+
+
+class _DaemonHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            request = json.loads(line)
+            if request["command"] == "ping":
+                self.wfile.write(json.dumps({"result": True}) + "\n")
+                continue
+            elif request["command"] == "shutdown":
+                self.wfile.write(json.dumps({"result": True}) + "\n")
+                self.server.running = False
+                return
+            try:
+                result = self.server.session.run(request.get("serial"), request["command"],
+                                                 request.get("args", []), request.get("snapshot", False))
+                response = {"result": result}
+            except Exception as e:
+                response = {"error": "%s: %s" % (type(e).__name__, e)}
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+
+def serve_daemon(path=None):
+    '''
+    serve commands over unix socket, keeping rpc servers, forwards and
+    snapshots of devices warm between commands, until shutdown.
+    '''
+    path = path or _daemon_socket()
+    if os.path.exists(path):
+        try:
+            _daemon_request(path, {"command": "ping"})
+        except socket.error:
+            os.remove(path)  # stale socket of dead daemon.
+        else:
+            raise EnvironmentError("Daemon is already running on %s." % path)
+    server = SocketServer.UnixStreamServer(path, _DaemonHandler)
+    server.session = _CommandSession()
+    server.running = True
+    try:
+        while server.running:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def _daemon_request(path, request):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(request) + "\n")
+        f = sock.makefile("rb")
+        try:
+            return json.loads(f.readline())
+        finally:
+            f.close()
+    finally:
+        sock.close()
+
+
+def main(argv=None):
+    '''command line entry, commands are sent to the daemon if it's running.'''
+    parser = argparse.ArgumentParser(prog="uiautomator", description="Android uiautomator command line.")
+    parser.add_argument("-s", "--serial", help="serial number of the device, $ANDROID_SERIAL by default.")
+    parser.add_argument("--socket", help="unix socket of the daemon, $UIAUTOMATOR_SOCKET by default.")
+    parser.add_argument("--no-daemon", action="store_true", help="run the command in this process.")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="evaluate info/exist selector on the last dumped hierarchy.")
+    parser.add_argument("command", choices=["click", "press", "dump", "screenshot", "info", "exist", "snapshot",
+                                            "daemon", "shutdown"])
+    parser.add_argument("args", nargs="*", help="x y, key, file name, or selector like text=OK.")
+    options = parser.parse_args(argv)
+    path = options.socket or _daemon_socket()
+    serial = options.serial or os.environ.get("ANDROID_SERIAL")
+
+    if options.command == "daemon":
+        serve_daemon(path)
+        return 0
+    args = options.args
+    filename = None
+    if options.command in ("dump", "screenshot"):
+        filename, args = (args[0] if args else None), []
+    if options.command == "shutdown":
+        response = _daemon_request(path, {"command": "shutdown"})
+    else:
+        request = {"serial": serial, "command": options.command, "args": args, "snapshot": options.snapshot}
+        response = None
+        if not options.no_daemon and os.path.exists(path):
+            try:
+                response = _daemon_request(path, request)
+            except socket.error:
+                pass  # daemon is not running.
+        if response is None:
+            try:
+                response = {"result": _CommandSession().run(serial, options.command, args, options.snapshot)}
+            except Exception as e:
+                response = {"error": "%s: %s" % (type(e).__name__, e)}
+    if "error" in response:
+        sys.stderr.write(response["error"] + "\n")
+        return 1
+    result = response["result"]
+    if options.command == "screenshot":
+        result = base64.b64decode(result)
+    elif isinstance(result, unicode):
+        result = result.encode("utf-8")
+    if options.command in ("dump", "screenshot"):
+        if filename:
+            with open(filename, "wb") as f:
+                f.write(result)
+        else:
+            sys.stdout.write(result)
+    elif options.command == "exist":
+        print json.dumps(result)
+        return 0 if result else 1
+    else:
+        print json.dumps(result, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())